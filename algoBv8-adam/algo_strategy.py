@@ -16,11 +16,14 @@ Advanced strategy tips:
   - You can analyze action frames by modifying on_action_frame function
 
   - The GameState.map object can be manually manipulated to create hypothetical 
-  board states. Though, we recommended making a copy of the map to preserve 
+  board states. Though, we recommended working on game_state.fork() to preserve 
   the actual current map state.
 """
 
 class AlgoStrategy(gamelib.AlgoCore):
+    # Turn states and action frames arrive already decoded, see AlgoCore.parsed_messages
+    parsed_messages = True
+
     def __init__(self):
         super().__init__()
         seed = random.randrange(maxsize)
@@ -54,9 +57,13 @@ class AlgoStrategy(gamelib.AlgoCore):
         unit deployments, and transmitting your intended deployments to the
         game engine.
         """
-        game_state = gamelib.GameState(self.config, turn_state)
+        game_state = gamelib.GameState(self.config, turn_state, lazy=True)
         gamelib.debug_write('Performing turn {} of your custom algo strategy'.format(game_state.turn_number))
         game_state.suppress_warnings(True)  #Comment or remove this line to enable warnings.
+        # If this turn runs too long, AlgoCore submits the basic defences instead
+        fallback = game_state.fork()
+        self.build_defences(fallback)
+        self.register_fallback(fallback)
         self.scoutv2(game_state)
 
         game_state.submit_turn()
@@ -246,8 +253,8 @@ class AlgoStrategy(gamelib.AlgoCore):
         vulnerable = []
         if len(location_options) == 0:
             return
-        for location in location_options:
-            path = game_state.find_path_to_edge(location)
+        paths = game_state.find_paths_to_edges(location_options)
+        for location, path in zip(location_options, paths):
             if len(path) < 20:
                 damages.append(float('infinity'))
                 continue
@@ -294,16 +301,13 @@ class AlgoStrategy(gamelib.AlgoCore):
         vulnerable = []
         if len(location_options) == 0:
             return
-        for location in location_options:
-            path = game_state.find_path_to_edge(location)
+        paths = game_state.find_paths_to_edges(location_options)
+        for location, path in zip(location_options, paths):
             if len(path) < 20:
                 damages.append(float('infinity'))
                 continue
-            damage = 0
-            for path_location in path:
-                # Get number of enemy turrets that can attack each location and multiply by turret damage
-                damage += len(game_state.get_attackers(path_location, user)) * gamelib.GameUnit(TURRET, game_state.config).damage_i
-            damages.append(damage)
+            # Sum the damage per frame of the enemy turrets that can attack each location
+            damages.append(game_state.path_damage(path, user))
             if user == 1:
                 vulnerable.append(path[-1])
         # Now just return the location that takes the least damage
@@ -313,13 +317,7 @@ class AlgoStrategy(gamelib.AlgoCore):
         return (location_options[damages.index(min(damages))] if user == 0 else vulnerable[damages.index(min(damages))])
 
     def detect_enemy_unit(self, game_state, unit_type=None, valid_x = None, valid_y = None):
-        total_units = 0
-        for location in game_state.game_map:
-            if game_state.contains_stationary_unit(location):
-                for unit in game_state.game_map[location]:
-                    if unit.player_index == 1 and (unit_type is None or unit.unit_type == unit_type) and (valid_x is None or location[0] in valid_x) and (valid_y is None or location[1] in valid_y):
-                        total_units += 1
-        return total_units
+        return game_state.game_map.count_units(1, unit_type, rows=valid_y, columns=valid_x, structures_only=True)
         
     def filter_blocked_locations(self, locations, game_state):
         filtered = []
@@ -328,7 +326,7 @@ class AlgoStrategy(gamelib.AlgoCore):
                 filtered.append(location)
         return filtered
 
-    def on_action_frame(self, turn_string):
+    def on_action_frame(self, state):
         """
         This is the action frame of the game. This function could be called 
         hundreds of times per turn and could slow the algo down so avoid putting slow code here.
@@ -336,7 +334,6 @@ class AlgoStrategy(gamelib.AlgoCore):
         Full doc on format of a game frame at in json-docs.html in the root of the Starterkit.
         """
         # Let's record at what position we get scored on
-        state = json.loads(turn_string)
         events = state["events"]
         breaches = events["breach"]
         for breach in breaches:
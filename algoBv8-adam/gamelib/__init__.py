@@ -16,6 +16,21 @@ Investigating it is useful for advanced players interested in getting data from
 The Navigation class in navigation.py contains functions related to path-finding, which are used by GameState in pathing related functions. 
 Investigating it is useful for advanced player who want to optimize the slow default pathing algorithm we provide. \n 
 
+The TranspositionTable class in transposition.py is a bounded cache keyed by board hashes, 
+used with GameState.memoize to reuse expensive evaluations across candidate plans and turns. \n
+
+The UnitArrays class in unit_arrays.py holds every unit on the board as parallel arrays, 
+which GameMap keeps up to date. It is useful for computing aggregates over all units quickly. \n
+
+The ActionPhaseSimulator class in simulator.py plays out the action phase that follows your turn frame by frame, 
+including movement, targeting, shields, self destructs, breaches and refunds, without changing your game state. \n
+
+The BatchSimulator class in batch_simulator.py runs many candidate attacks against the same board together, 
+sharing the work they have in common, so every spawn location and unit type can be scored in one call. \n
+
+The AttackPlanner class in planner.py samples attacks built from several mobile unit types, spawn locations and counts, 
+and keeps the best one found until a deadline taken from the turn time limit. \n
+
 util.py contains a small handful of functions that help with communication, including the debug-printing function, debug_write().
 """
 
@@ -24,6 +39,11 @@ from .util import debug_write
 from .game_state import GameState
 from .unit import GameUnit
 from .game_map import GameMap
+from .transposition import TranspositionTable
+from .unit_arrays import UnitArrays
+from .simulator import ActionPhaseSimulator
+from .batch_simulator import BatchSimulator
+from .planner import AttackPlanner
 
-__all__ = ["algocore", "game_state", "game_map", "navigation", "unit", "util"]
+__all__ = ["algocore", "batch_simulator", "game_state", "game_map", "navigation", "planner", "simulator", "transposition", "unit", "unit_arrays", "util"]
  
\ No newline at end of file
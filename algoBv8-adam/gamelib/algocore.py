@@ -1,7 +1,29 @@
 import json
+import threading
+import time
 
 from .game_state import GameState
-from .util import get_command, debug_write, BANNER_TEXT, send_command
+from .util import get_command, debug_write, BANNER_TEXT, open_submission, submit_commands
+
+def _scan_list(message, key):
+    """Reads the flat list stored under a top level key of a message without decoding the whole message.
+    Returns None if the key is not in the message.
+    """
+    start = message.find('"{}"'.format(key))
+    if start < 0:
+        return None
+    start = message.find("[", start)
+    end = message.find("]", start)
+    if start < 0 or end < 0:
+        return None
+    return json.loads(message[start:end + 1])
+
+
+# Seconds a turn may take when the config does not say, matching the engine's default soft limit
+DEFAULT_TURN_BUDGET = 5.0
+# Seconds before the engine gives up on a turn when the config does not say (timingAndReplay.waitTimeBotMax)
+DEFAULT_TURN_TIME_LIMIT = 35.0
+
 
 class AlgoCore(object):
     """
@@ -10,10 +32,42 @@ class AlgoCore(object):
 
     Attributes :
         * config (JSON): json object containing information about the game
+        * turn_budget (float): The seconds a turn may take, the engine's soft limit (timingAndReplay.waitTimeBotSoft)
+        * turn_times (list): For each turn played, a dict with the "turn" number, the seconds on_turn took
+          under "compute_time", and the time in milliseconds the engine reported for that turn under "my_time".
+          The engine reports a turn's time with the next turn, so the last entry's "my_time" is None.
+        * checkpoints (list): The (name, elapsed seconds) of each checkpoint reached this turn
+        * turn_time_limit (float): The seconds before the engine gives up on a turn (timingAndReplay.waitTimeBotMax)
+        * fallback_fraction (float): The fraction of turn_time_limit after which the fallback plan is submitted
+        * background_results (dict): The result of each background task from the last action phase, see register_background_task
+        * background_wait (float): The most seconds a turn waits for background tasks to finish before on_turn.
+          The engine's clock is already running, so the wait is charged to the turn: it counts against time_remaining
+          and the fallback watchdog, and never takes more than half of the turn budget that is left.
+        * parsed_messages (bool): If True, on_turn, on_action_frame and background tasks get each message as the dict
+          it decodes to, decoded once. If False they get the message string, as before.
 
     """
+    parsed_messages = False
+
     def __init__(self):
         self.config = None
+        self.turn_budget = DEFAULT_TURN_BUDGET
+        self.turn_times = []
+        self.checkpoints = []
+        self._turn_start = None
+        self.turn_time_limit = DEFAULT_TURN_TIME_LIMIT
+        self.fallback_fraction = 0.8
+        self._fallback = None
+        self._watchdog = None
+        self.background_results = {}
+        self.background_wait = 1.0
+        self._background_tasks = []
+        self._background_frames = []
+        self._background_pending = {}
+        self._background_busy = False
+        self._background_generation = 0
+        self._background_condition = threading.Condition()
+        self._background_thread = None
 
     def on_game_start(self, config):
         """
@@ -31,9 +85,169 @@ class AlgoCore(object):
         algo_strategy.py inherits from AlgoCore and overrides this on turn function. 
         Adjusting the on_turn function in algo_strategy is the main way to adjust your algo's logic. 
         """
-        send_command("[]")
-        send_command("[]")
+        submit_commands("[]", "[]")
     
+    def time_remaining(self):
+        """Gets the time left before the current turn goes over its budget
+
+        Returns:
+            The seconds left, negative once the turn is late. The whole budget outside of a turn.
+        """
+        if self._turn_start is None:
+            return self.turn_budget
+        return self.turn_budget - (time.monotonic() - self._turn_start)
+
+    def turn_elapsed(self):
+        """Gets the seconds since the current turn's message arrived, 0 outside of a turn"""
+        if self._turn_start is None:
+            return 0
+        return time.monotonic() - self._turn_start
+
+    def turn_deadline(self, fraction=1):
+        """Gets the time.monotonic() time at which a fraction of the turn budget will have been used,
+        for searches that take a deadline such as AttackPlanner.search
+        """
+        start = time.monotonic() if self._turn_start is None else self._turn_start
+        return start + self.turn_budget * fraction
+
+    def checkpoint(self, name=None, reserve=0):
+        """Records that a stage of the turn was reached and says whether there is time for more work
+
+        Long searches should call this between steps and stop once it returns False.
+
+        Args:
+            name: A label for this point in the turn, kept in checkpoints
+            reserve: The seconds to keep in hand for the work still needed to finish the turn
+
+        Returns:
+            True if more than reserve seconds of the turn budget are left
+        """
+        self.checkpoints.append((name, self.turn_elapsed()))
+        return self.time_remaining() > reserve
+
+    def register_fallback(self, game_state):
+        """Registers the turn to submit if on_turn runs out of time
+
+        Call this early in on_turn with a cheap plan, such as a fork of the GameState with only the
+        basic defences built. If submit_turn has not been called by fallback_fraction of the turn time
+        limit, the fallback is submitted instead, and the turn on_turn submits later is discarded.
+        Registering again replaces the fallback.
+
+        Args:
+            game_state: A GameState holding the fallback plan. Its spawns so far are copied.
+        """
+        self._fallback = (json.dumps(game_state._build_stack), json.dumps(game_state._deploy_stack))
+
+    def _submit_fallback(self):
+        """Run by the watchdog timer when a turn takes too long"""
+        build_string, deploy_string = self._fallback or ("[]", "[]")
+        if submit_commands(build_string, deploy_string):
+            debug_write("Turn ran past {} seconds, submitted the fallback plan".format(self.fallback_fraction * self.turn_time_limit))
+
+    def register_background_task(self, name, task, every_frame=False):
+        """Registers work to do in a worker thread while the action phase frames arrive
+
+        Tasks run while the algo would otherwise wait on the engine, and their results are ready in
+        background_results[name] when on_turn is called. A task is called as task(frame, result), where
+        frame is an action frame, a string or a dict depending on parsed_messages, and result is what the
+        task returned last during this action phase, None at first. Its return value becomes the new result.
+
+        Args:
+            name: The key of the task's result in background_results
+            task: The function to run
+            every_frame: If True the task sees every frame in order, for example to summarize the events.
+                If False it only sees the latest frame when it runs, for example to re-score paths against the latest board.
+        """
+        self._background_tasks.append((name, task, every_frame))
+
+    def _queue_background_frame(self, frame):
+        """Hands an action frame to the background tasks, starting the worker thread the first time"""
+        if not self._background_tasks:
+            return
+        with self._background_condition:
+            if self._background_thread is None:
+                self._background_thread = threading.Thread(target=self._background_worker, daemon=True)
+                self._background_thread.start()
+            self._background_frames.append(frame)
+            self._background_condition.notify_all()
+
+    def _background_worker(self):
+        """Runs the background tasks on the queued frames, forever"""
+        condition = self._background_condition
+        while True:
+            with condition:
+                condition.wait_for(lambda: self._background_frames)
+                frames = self._background_frames
+                self._background_frames = []
+                self._background_busy = True
+                generation = self._background_generation
+                results = dict(self._background_pending)
+            for name, task, every_frame in self._background_tasks:
+                for frame in (frames if every_frame else frames[-1:]):
+                    try:
+                        results[name] = task(frame, results.get(name))
+                    except Exception as error:
+                        debug_write("Background task {} failed: {}".format(name, error))
+            with condition:
+                # Results of frames from an action phase that a turn already collected are dropped
+                if generation == self._background_generation:
+                    self._background_pending = results
+                self._background_busy = False
+                condition.notify_all()
+
+    def _collect_background_results(self):
+        """Waits up to background_wait for the background tasks, then makes their results available to on_turn.
+        Called once the turn clock has started, so the wait is part of the turn, see background_wait.
+        """
+        if not self._background_tasks:
+            return
+        # Leave on_turn at least half of what is left of the budget, and don't wait at all once the turn is late
+        timeout = max(0, min(self.background_wait, self.time_remaining() / 2))
+        with self._background_condition:
+            finished = self._background_condition.wait_for(
+                lambda: not self._background_frames and not self._background_busy, timeout)
+            if not finished:
+                debug_write("Background tasks did not finish in time, using the results so far")
+            self.background_results = self._background_pending
+            self._background_pending = {}
+            self._background_frames = []
+            self._background_generation += 1
+
+    def _wants_action_frames(self):
+        """Action frames are only decoded and dispatched if on_action_frame is overridden or a background task needs them"""
+        return type(self).on_action_frame is not AlgoCore.on_action_frame or bool(self._background_tasks)
+
+    def _decode(self, message):
+        """Gets a message in the form on_turn and on_action_frame expect, see parsed_messages"""
+        return json.loads(message) if self.parsed_messages else message
+
+    def _set_turn_budget(self, config):
+        """Reads the turn time limits from the game config"""
+        timing = config.get("timingAndReplay", {})
+        if timing.get("waitTimeBotSoft"):
+            self.turn_budget = timing["waitTimeBotSoft"] / 1000
+        if timing.get("waitTimeBotMax"):
+            self.turn_time_limit = timing["waitTimeBotMax"] / 1000
+
+    def _begin_turn(self, turn_number, my_time):
+        """Starts the turn clock and the fallback watchdog. my_time is the engine's time in milliseconds for the previous turn."""
+        self._turn_start = time.monotonic()
+        self.checkpoints = []
+        self._fallback = None
+        open_submission()
+        self._watchdog = threading.Timer(self.fallback_fraction * self.turn_time_limit, self._submit_fallback)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+        if self.turn_times and self.turn_times[-1]["my_time"] is None:
+            self.turn_times[-1]["my_time"] = my_time
+        self.turn_times.append({"turn": turn_number, "compute_time": None, "my_time": None})
+
+    def _end_turn(self):
+        """Stops the turn clock and the fallback watchdog, and records how long the turn took"""
+        self._watchdog.cancel()
+        self.turn_times[-1]["compute_time"] = self.turn_elapsed()
+        self._turn_start = None
+
     def on_action_frame(self, action_frame_game_state):
         """
         After each deploy phase, the game engine will run the action phase of the round.
@@ -57,26 +271,36 @@ class AlgoCore(object):
             # Note: Python blocks and hangs on stdin. Can cause issues if connections aren't setup properly and may need to
             # manually kill this Python program.
             game_state_string = get_command()
-            if "replaySave" in game_state_string:
+            # Messages are told apart by scanning for turnInfo, so frames nobody listens to are never decoded
+            turn_info = _scan_list(game_state_string, "turnInfo")
+            if turn_info is None and "replaySave" in game_state_string:
                 """
                 This means this must be the config file. So, load in the config file as a json and add it to your AlgoStrategy class.
                 """
                 parsed_config = json.loads(game_state_string)
+                self._set_turn_budget(parsed_config)
                 self.on_game_start(parsed_config)
-            elif "turnInfo" in game_state_string:
-                state = json.loads(game_state_string)
-                stateType = int(state.get("turnInfo")[0])
+            elif turn_info is not None:
+                stateType = int(turn_info[0])
                 if stateType == 0:
                     """
                     This is the game turn game state message. Algo must now print to stdout 2 lines, one for build phase one for
                     deploy phase. Printing is handled by the provided functions.
                     """
-                    self.on_turn(game_state_string)
+                    self._begin_turn(int(turn_info[1]), float(_scan_list(game_state_string, "p1Stats")[3]))
+                    self._collect_background_results()
+                    try:
+                        self.on_turn(self._decode(game_state_string))
+                    finally:
+                        self._end_turn()
                 elif stateType == 1:
                     """
                     If stateType == 1, this game_state_string string represents a single frame of an action phase
                     """
-                    self.on_action_frame(game_state_string)
+                    if self._wants_action_frames():
+                        frame = self._decode(game_state_string)
+                        self._queue_background_frame(frame)
+                        self.on_action_frame(frame)
                 elif stateType == 2:
                     """
                     This is the end game message. This means the game is over so break and finish the program.
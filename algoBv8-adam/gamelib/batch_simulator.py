@@ -0,0 +1,384 @@
+import math
+from .unit import get_unit_stats
+from .game_map import BOTTOM_EDGE_LOCATIONS
+
+
+class _Stack:
+    """Mobile units of one type that were spawned together. They share a tile, a path and a move timer."""
+    __slots__ = ("unit_type", "stats", "info", "x", "y", "healths", "target_edge", "path", "path_index",
+                 "steps", "progress", "shielded_by")
+
+    def __init__(self, unit_type, stats, info, x, y, num, target_edge):
+        self.unit_type = unit_type
+        self.stats = stats
+        self.info = info
+        self.x = x
+        self.y = y
+        self.healths = [stats.max_health] * num
+        self.target_edge = target_edge
+        self.path = None
+        self.path_index = 0
+        self.steps = 0
+        self.progress = 0
+        self.shielded_by = set()
+
+
+class _Scenario:
+    """The state of one attack being simulated"""
+    __slots__ = ("stacks", "structure_health", "destroyed", "breaches", "player_damage", "damage_dealt", "self_destructs", "frames")
+
+    def __init__(self, structure_health):
+        self.stacks = []
+        self.structure_health = list(structure_health)
+        self.destroyed = frozenset()
+        self.breaches = 0
+        self.player_damage = 0
+        self.damage_dealt = 0
+        self.self_destructs = 0
+        self.frames = 0
+
+
+class BatchSimulator:
+    """Simulates many candidate attacks against the same board at once
+
+    Every scenario is a list of mobile units one player could deploy. All scenarios start from the
+    same board and advance together, frame by frame, with the same rules as ActionPhaseSimulator.
+    Everything that does not depend on the scenario is worked out once and shared: which enemy
+    structures can hit each tile, which structures a unit on a tile could target, shields, and the
+    paths for each set of destroyed structures. A scenario only holds its mobile units and the
+    health of the enemy structures.
+
+    The defending player's mobile units are not simulated and the attacking player's structures
+    do not attack, so the results describe an attack running into the defence as it stands.
+
+    Attributes :
+        * game_state (GameState): The board every scenario starts from
+        * player_index (int): The attacking player, 0 for you 1 for the enemy
+
+    """
+    def __init__(self, game_state, player_index=0):
+        """Works out the parts of the simulation shared by every scenario
+
+        Args:
+            game_state: The board to attack. It is not modified.
+            player_index: The attacking player, 0 for you 1 for the enemy
+
+        """
+        self.game_state = game_state
+        self.player_index = player_index
+        self.config = game_state.config
+        game_map = game_state.game_map
+        self.__stats = get_unit_stats(self.config)
+        self.__unit_info = {info.get("shorthand"): info for info in self.config["unitInformation"]}
+        self.__breach_sp = self.config["resources"].get("coresForPlayerDamage", 1)
+        size = game_map.ARENA_SIZE
+        half = game_map.HALF_ARENA
+
+        # The defending structures, in tile order so ties are broken like get_target
+        self.__structures = []
+        for location in game_map.get_locations_from_mask(game_map._player_masks[1 - player_index]):
+            for unit in game_map[location]:
+                if unit.stationary:
+                    self.__structures.append(unit)
+        self.__structure_health = [unit.health for unit in self.__structures]
+        self.__structure_tiles = {}
+        # For each tile, the defending structures that can attack a mobile unit there
+        self.__tile_attackers = [[] for _ in range(size * size)]
+        for index, unit in enumerate(self.__structures):
+            self.__structure_tiles[unit.x * size + unit.y] = index
+            if unit.damage_i > 0:
+                for i, j in game_map.get_locations_in_range([unit.x, unit.y], unit.attackRange):
+                    self.__tile_attackers[i * size + j].append(index)
+
+        # For each tile, the (shield id, amount) of the attacking player's supports that shield it
+        self.__tile_shields = [[] for _ in range(size * size)]
+        for location in game_map.get_locations_from_mask(game_map._player_masks[player_index]):
+            for unit in game_map[location]:
+                if not unit.stationary or unit.shieldRange <= 0 or unit.shieldPerUnit + unit.shieldBonusPerY <= 0:
+                    continue
+                rows = unit.y if player_index == 0 else size - 1 - unit.y
+                amount = unit.shieldPerUnit + unit.shieldBonusPerY * rows
+                for i, j in game_map.get_locations_in_range([unit.x, unit.y], unit.shieldRange):
+                    self.__tile_shields[i * size + j].append((unit.x * size + unit.y, amount))
+
+        self.__target_lists = {}
+        self.__path_states = {}
+        self.__paths = {}
+        self.__edge_tiles = {}
+        self.__y_sign = 1 if player_index == 0 else -1
+        self.__x_center = half - 0.5
+
+    def run(self, scenarios, max_frames=1000):
+        """Simulates every scenario until none of its mobile units are left
+
+        Args:
+            scenarios: A list of scenarios, each a list of (unit_type, [x, y], num) mobile units to deploy.
+                Units on a blocked or out of bounds location are left out.
+            max_frames: The most frames to simulate, in case units never leave the board
+
+        Returns:
+            A list with a dict for each scenario, holding the number of units that got through under "breaches",
+            the health the defender loses under "player_damage", the SP gained from it under "breach_SP", the
+            damage dealt to structures under "damage_dealt", the number of structures destroyed under
+            "structures_destroyed", their [x, y] locations under "destroyed", the number of units that
+            self destructed under "self_destructs" and the number of frames simulated under "frames"
+
+        """
+        game_state = self.game_state
+        game_map = game_state.game_map
+        running = []
+        results = []
+        for deploys in scenarios:
+            scenario = _Scenario(self.__structure_health)
+            for unit_type, location, num in deploys:
+                if num <= 0 or not game_map.in_arena_bounds(location) or game_state.contains_stationary_unit(location):
+                    continue
+                target_edge = game_state.get_target_edge(location)
+                scenario.stacks.append(_Stack(unit_type, self.__stats[unit_type, False], self.__unit_info[unit_type],
+                                              location[0], location[1], num, target_edge))
+            results.append(scenario)
+            if scenario.stacks:
+                running.append(scenario)
+
+        frame = 0
+        while running and frame < max_frames:
+            frame += 1
+            for scenario in running:
+                scenario.frames = frame
+                self.__step(scenario)
+            running = [scenario for scenario in running if scenario.stacks]
+
+        summaries = []
+        for scenario in results:
+            destroyed = sorted(scenario.destroyed)
+            summaries.append({
+                "breaches": scenario.breaches,
+                "player_damage": scenario.player_damage,
+                "breach_SP": scenario.player_damage * self.__breach_sp,
+                "damage_dealt": scenario.damage_dealt,
+                "structures_destroyed": len(destroyed),
+                "destroyed": [[self.__structures[index].x, self.__structures[index].y] for index in destroyed],
+                "self_destructs": scenario.self_destructs,
+                "frames": scenario.frames,
+            })
+        return summaries
+
+    def simulate_spawns(self, unit_types, num=1, locations=None, max_frames=1000):
+        """Simulates one stack of units for every spawn location and unit type
+
+        Args:
+            unit_types: The mobile unit types to try
+            num: The number of units in each stack
+            locations: The spawn locations to try. Every unblocked location on the attacking player's edges if None.
+            max_frames: The most frames to simulate
+
+        Returns:
+            A dict from (unit_type, (x, y)) to the result of that scenario, see run
+
+        """
+        game_state = self.game_state
+        if locations is None:
+            if self.player_index == 0:
+                edge_locations = BOTTOM_EDGE_LOCATIONS
+            else:
+                game_map = game_state.game_map
+                edge_locations = [tuple(location) for edge in (game_map.TOP_LEFT, game_map.TOP_RIGHT)
+                                  for location in game_map.get_edge_locations(edge)]
+            locations = [list(location) for location in sorted(edge_locations)
+                         if not game_state.contains_stationary_unit(location)]
+        keys = []
+        scenarios = []
+        for unit_type in unit_types:
+            for location in locations:
+                keys.append((unit_type, (location[0], location[1])))
+                scenarios.append([(unit_type, location, num)])
+        return dict(zip(keys, self.run(scenarios, max_frames)))
+
+    def __step(self, scenario):
+        """Advances one scenario by a frame, in the same order as ActionPhaseSimulator"""
+        size = self.game_state.ARENA_SIZE
+        structure_health = scenario.structure_health
+
+        for stack in scenario.stacks:
+            for shield, amount in self.__tile_shields[stack.x * size + stack.y]:
+                if shield not in stack.shielded_by:
+                    stack.shielded_by.add(shield)
+                    stack.healths = [health + amount for health in stack.healths]
+
+        # Movement, breaches and self destructs
+        destroyed = []
+        gone = False
+        for stack in scenario.stacks:
+            stack.progress += stack.stats.speed
+            if stack.progress < 1:
+                continue
+            stack.progress -= 1
+            if stack.path is None:
+                stack.path = self.__path(scenario.destroyed, stack.x, stack.y, stack.target_edge)
+                stack.path_index = 0
+            if stack.path and stack.path_index + 1 < len(stack.path):
+                stack.path_index += 1
+                stack.steps += 1
+                stack.x, stack.y = stack.path[stack.path_index]
+                if (stack.x, stack.y) in self.__edge(stack.target_edge):
+                    scenario.breaches += len(stack.healths)
+                    scenario.player_damage += stack.info.get("playerBreachDamage", 1) * len(stack.healths)
+                    stack.healths = []
+                    gone = True
+                continue
+            scenario.self_destructs += len(stack.healths)
+            self.__self_destruct(scenario, stack, destroyed)
+            stack.healths = []
+            gone = True
+        if gone:
+            scenario.stacks = [stack for stack in scenario.stacks if stack.healths]
+
+        # Targets are all chosen before any damage is dealt
+        structure_damage = {}
+        for stack in scenario.stacks:
+            if stack.stats.damage_f <= 0:
+                continue
+            target = self.__structure_target(scenario, stack)
+            if target is not None:
+                damage = stack.stats.damage_f * len(stack.healths)
+                structure_damage[target] = structure_damage.get(target, 0) + damage
+        unit_damage = {}
+        attackers = set()
+        for stack in scenario.stacks:
+            attackers.update(self.__tile_attackers[stack.x * size + stack.y])
+        for attacker in attackers:
+            if attacker in scenario.destroyed:
+                continue
+            target = self.__unit_target(scenario, attacker)
+            if target is not None:
+                unit_damage[target] = unit_damage.get(target, 0) + self.__structures[attacker].damage_i
+
+        for (stack_index, unit_index), damage in unit_damage.items():
+            scenario.stacks[stack_index].healths[unit_index] -= damage
+        for index, damage in structure_damage.items():
+            scenario.damage_dealt += damage
+            structure_health[index] -= damage
+            if structure_health[index] <= 0 and index not in destroyed:
+                destroyed.append(index)
+
+        # Units without health are taken off the board, and a destroyed structure makes every stack re-path
+        if unit_damage:
+            for stack in scenario.stacks:
+                stack.healths = [health for health in stack.healths if health > 0]
+            scenario.stacks = [stack for stack in scenario.stacks if stack.healths]
+        if destroyed:
+            scenario.destroyed = scenario.destroyed.union(destroyed)
+            for stack in scenario.stacks:
+                stack.path = None
+
+    def __self_destruct(self, scenario, stack, destroyed):
+        """Damages the defending structures around a stack that cannot move any further, if it walked far enough.
+        Structures brought to no health are added to destroyed.
+        """
+        info = stack.info
+        damage = info.get("selfDestructDamageTower", 0)
+        if stack.steps < info.get("selfDestructStepsRequired", 0) or info.get("selfDestructRange", 0) <= 0 or damage <= 0:
+            return
+        size = self.game_state.ARENA_SIZE
+        structure_health = scenario.structure_health
+        in_range = []
+        for i, j in self.game_state.game_map.get_locations_in_range([stack.x, stack.y], info["selfDestructRange"]):
+            index = self.__structure_tiles.get(i * size + j)
+            if index is not None and index not in scenario.destroyed:
+                in_range.append(index)
+        # Each unit explodes on its own, and skips structures an earlier explosion already finished off
+        for _ in stack.healths:
+            for index in in_range:
+                if structure_health[index] > 0:
+                    structure_health[index] -= damage
+                    scenario.damage_dealt += damage
+                    if structure_health[index] <= 0:
+                        destroyed.append(index)
+
+    def __structure_target(self, scenario, stack):
+        """Gets the index of the defending structure a stack attacks, using the get_target priority"""
+        candidates = self.__target_lists.get((stack.x, stack.y, stack.stats.attackRange))
+        if candidates is None:
+            candidates = self.__candidates(stack.x, stack.y, stack.stats.attackRange)
+        structure_health = scenario.structure_health
+        destroyed = scenario.destroyed
+        best = None
+        best_key = None
+        for distance, index, y_key, x_key in candidates:
+            if best_key is not None and distance > best_key[0]:
+                break
+            if index in destroyed:
+                continue
+            key = (distance, structure_health[index], y_key, x_key)
+            if best_key is None or key < best_key:
+                best = index
+                best_key = key
+        return best
+
+    def __candidates(self, x, y, attack_range):
+        """Lists the defending structures in range of a tile, nearest first and in tile order within a distance"""
+        game_map = self.game_state.game_map
+        size = game_map.ARENA_SIZE
+        candidates = []
+        for i, j in game_map.get_locations_in_range([x, y], attack_range):
+            index = self.__structure_tiles.get(i * size + j)
+            if index is not None:
+                candidates.append((math.sqrt((i - x) ** 2 + (j - y) ** 2), index,
+                                   self.__y_sign * j, -abs(self.__x_center - i)))
+        candidates.sort(key=lambda candidate: (candidate[0], candidate[1]))
+        self.__target_lists[x, y, attack_range] = candidates
+        return candidates
+
+    def __unit_target(self, scenario, attacker):
+        """Gets the (stack, unit) a defending structure attacks, using the get_target priority"""
+        unit = self.__structures[attacker]
+        size = self.game_state.ARENA_SIZE
+        range_tiles = self.__range_tiles(unit)
+        best = None
+        best_key = None
+        for stack_index, stack in enumerate(scenario.stacks):
+            tile = stack.x * size + stack.y
+            if tile not in range_tiles:
+                continue
+            health = min(stack.healths)
+            key = (math.sqrt((stack.x - unit.x) ** 2 + (stack.y - unit.y) ** 2), health,
+                   -self.__y_sign * stack.y, -abs(self.__x_center - stack.x), tile)
+            if best_key is None or key < best_key:
+                best = (stack_index, stack.healths.index(health))
+                best_key = key
+        return best
+
+    def __range_tiles(self, unit):
+        """Gets the set of tiles a defending structure can attack"""
+        key = ("range", unit.x, unit.y, unit.attackRange)
+        tiles = self.__target_lists.get(key)
+        if tiles is None:
+            size = self.game_state.ARENA_SIZE
+            tiles = {i * size + j for i, j in self.game_state.game_map.get_locations_in_range([unit.x, unit.y], unit.attackRange)}
+            self.__target_lists[key] = tiles
+        return tiles
+
+    def __edge(self, target_edge):
+        """Gets the set of (x, y) tiles on an edge"""
+        tiles = self.__edge_tiles.get(target_edge)
+        if tiles is None:
+            tiles = {tuple(location) for location in self.game_state.game_map.get_edge_locations(target_edge)}
+            self.__edge_tiles[target_edge] = tiles
+        return tiles
+
+    def __path(self, destroyed, x, y, target_edge):
+        """Gets the path from [x, y] to an edge once the given structures are destroyed, shared by every scenario"""
+        key = (destroyed, x, y, target_edge)
+        path = self.__paths.get(key)
+        if path is None:
+            state = self.__path_states.get(destroyed)
+            if state is None:
+                state = self.game_state.fork()
+                state.suppress_warnings(True)
+                for index in destroyed:
+                    structure = self.__structures[index]
+                    state.game_map.remove_unit([structure.x, structure.y])
+                self.__path_states[destroyed] = state
+            path = state.find_path_to_edge([x, y], target_edge) or []
+            self.__paths[key] = path
+        return path
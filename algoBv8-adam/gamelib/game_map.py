@@ -1,6 +1,120 @@
+import copy
 import math
-from .unit import GameUnit
+from .unit import GameUnit, get_unit_stats
+from .unit_arrays import UnitArrays
 from .util import debug_write
+from .navigation import ARENA_SIZE, HALF_ARENA, IN_ARENA
+
+# Every location of the diamond shaped board, bottom row first and left to right within a row
+ARENA_LOCATIONS = tuple((x, y) for y in range(ARENA_SIZE) for x in range(ARENA_SIZE) if IN_ARENA[x * ARENA_SIZE + y])
+BOTTOM_HALF_LOCATIONS = tuple(location for location in ARENA_LOCATIONS if location[1] < HALF_ARENA)
+TOP_HALF_LOCATIONS = tuple(location for location in ARENA_LOCATIONS if location[1] >= HALF_ARENA)
+# The bottom left and bottom right edges, where player 0 can deploy mobile units
+BOTTOM_EDGE_LOCATIONS = frozenset([(HALF_ARENA - 1 - num, num) for num in range(HALF_ARENA)] +
+                                  [(HALF_ARENA + num, num) for num in range(HALF_ARENA)])
+
+# Range lookup tables shared by every GameMap, keyed by (radius, getHitRadius)
+_RANGE_TABLES = {}
+RANGE_KEYS = ["attackRange", "shieldRange", "selfDestructRange"]
+
+
+# Zobrist keys, keyed by (tile, unit type, owner, upgraded, health bucket)
+_ZOBRIST_KEYS = {}
+ZOBRIST_MASK = (1 << 64) - 1
+HEALTH_BUCKET = 1
+
+
+def _splitmix64(seed):
+    """Mixes a 64 bit seed into a well distributed 64 bit value"""
+    z = (seed + 0x9E3779B97F4A7C15) & ZOBRIST_MASK
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & ZOBRIST_MASK
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & ZOBRIST_MASK
+    return z ^ (z >> 31)
+
+
+def _zobrist_key(unit_type, player_index, upgraded, health, x, y):
+    """Gets the hash key of a unit standing on [x, y]. Keys are the same in every process."""
+    bucket = int(health // HEALTH_BUCKET) if health > 0 else 0
+    state = (x * ARENA_SIZE + y, unit_type, player_index, upgraded, bucket)
+    key = _ZOBRIST_KEYS.get(state)
+    if key is None:
+        seed = state[0] | ((player_index or 0) & 3) << 10 | int(upgraded) << 12 | (bucket & 0xFFFFF) << 13
+        seed |= int.from_bytes(unit_type.encode()[:3], "little") << 33
+        key = _splitmix64(seed)
+        _ZOBRIST_KEYS[state] = key
+    return key
+
+
+def _build_range_table(radius, hit_radius):
+    """Builds the get_locations_in_range result for every arena tile, indexed by tile id"""
+    search_radius = math.ceil(radius)
+    offsets = []
+    for dx in range(-search_radius, search_radius + 1):
+        for dy in range(-search_radius, search_radius + 1):
+            # A unit with a given range affects all locations whose centers are within that range + get hit radius
+            if math.sqrt(dx ** 2 + dy ** 2) < radius + hit_radius:
+                offsets.append((dx, dy))
+
+    table = [None] * (ARENA_SIZE * ARENA_SIZE)
+    for x, y in ARENA_LOCATIONS:
+        locations = []
+        for dx, dy in offsets:
+            i, j = x + dx, y + dy
+            if 0 <= i < ARENA_SIZE and 0 <= j < ARENA_SIZE and IN_ARENA[i * ARENA_SIZE + j]:
+                locations.append((i, j))
+        table[x * ARENA_SIZE + y] = tuple(locations)
+    return table
+
+
+# get_locations_in_range results as bitmasks, keyed like _RANGE_TABLES
+_RANGE_MASKS = {}
+
+# Coverage tables shared by every GameMap, keyed by (attackRange, search limit)
+_COVERAGE_TABLES = {}
+
+
+def _coverage_table(attack_range, limit):
+    """Gets, for every arena tile, the ids of the tiles a unit there can attack.
+    Matches GameState.get_attackers, which searches tiles closer than limit and keeps those within attack_range.
+    """
+    table = _COVERAGE_TABLES.get((attack_range, limit))
+    if table is not None:
+        return table
+    search_radius = math.ceil(attack_range)
+    offsets = []
+    for dx in range(-search_radius, search_radius + 1):
+        for dy in range(-search_radius, search_radius + 1):
+            distance = math.sqrt(dx ** 2 + dy ** 2)
+            if distance <= attack_range and distance < limit:
+                offsets.append((dx, dy))
+    table = [None] * (ARENA_SIZE * ARENA_SIZE)
+    for x, y in ARENA_LOCATIONS:
+        tiles = []
+        for dx, dy in offsets:
+            i, j = x + dx, y + dy
+            if 0 <= i < ARENA_SIZE and 0 <= j < ARENA_SIZE and IN_ARENA[i * ARENA_SIZE + j]:
+                tiles.append(i * ARENA_SIZE + j)
+        table[x * ARENA_SIZE + y] = tuple(tiles)
+    _COVERAGE_TABLES[(attack_range, limit)] = table
+    return table
+
+
+def _config_range_tables(config, hit_radius):
+    """Gets the range tables for every range used by a unit in config, base and upgraded"""
+    radii = set()
+    for unit_info in config["unitInformation"]:
+        for stats in (unit_info, unit_info.get("upgrade", {})):
+            for key in RANGE_KEYS:
+                if stats.get(key, 0) > 0:
+                    radii.add(stats[key])
+    tables = {}
+    for radius in radii:
+        table = _RANGE_TABLES.get((radius, hit_radius))
+        if table is None:
+            table = _build_range_table(radius, hit_radius)
+            _RANGE_TABLES[(radius, hit_radius)] = table
+        tables[radius] = table
+    return tables
 
 class GameMap:
     """Holds data about the current game map and provides functions
@@ -9,6 +123,9 @@ class GameMap:
     game_map[x, y] will return a list of Units located at that location, 
     or an empty list if there are no units at the location
 
+    Iterating over a GameMap yields every location in the arena as an [x, y] list.
+    Each loop gets its own iterator, so loops over the same map can be nested.
+
     Attributes :
         * config (JSON): Contains information about the current game rules
         * enable_warnings (bool): If true, debug messages for game_map functions will print out
@@ -36,36 +153,85 @@ class GameMap:
         self.BOTTOM_LEFT = 2
         self.BOTTOM_RIGHT = 3
         self.__map = self.__empty_grid()
-        self.__start = [13,0]
+        self._hit_radius = config["unitInformation"][0].get('getHitRadius', 0)
+        self._range_tables = _config_range_tables(config, self._hit_radius)
+        self._range_masks = {}
+        self._unit_info = {info.get("shorthand"): info for info in config["unitInformation"]}
+        self._unit_stats = get_unit_stats(config)
+        max_range = 0
+        for unit_info in config["unitInformation"]:
+            if unit_info.get('attackRange', 0) >= max_range:
+                max_range = unit_info.get('attackRange', 0)
+        self._attack_limit = max_range + self._hit_radius
+        self._threat_maps = [[0] * (self.ARENA_SIZE * self.ARENA_SIZE), [0] * (self.ARENA_SIZE * self.ARENA_SIZE)]
+        # get_durability_map results, keyed by player and stored with the board hash they were computed for
+        self._durability_maps = {}
+        # For each defending player and tile, a bitmask of the enemy structures that can attack the tile
+        self._attacker_masks = [[0] * (self.ARENA_SIZE * self.ARENA_SIZE), [0] * (self.ARENA_SIZE * self.ARENA_SIZE)]
+        self._structure_mask = 0
+        self._type_masks = {}
+        self._player_masks = [0, 0]
+        self._upgraded_masks = [0, 0]
+        self._removal_masks = [0, 0]
+        self._unit_index = {}
+        self._zobrist = 0
+        self._unit_arrays = UnitArrays(config)
+        self._lazy_units = None
+        self._owned_tiles = None
+        self._shared_tiles = None
+        self._undo_log = []
+        self._undo_marks = []
     
     def __getitem__(self, location):
         if len(location) == 2 and self.in_arena_bounds(location):
             x,y = location
-            return self.__map[x][y]
+            return self.__owned_tile(x, y)
         self._invalid_coordinates(location)
 
     def __setitem__(self, location, val):
         if type(location) == tuple and len(location) == 2 and self.in_arena_bounds(location):
-            self.__map[location[0]][location[1]] = val
+            x, y = location
+            self.__record_tile(x, y)
+            for unit in self.__tile(x, y):
+                self._unindex_unit(unit, x, y)
+            self.__set_tile(x, y, val)
+            for unit in val:
+                self._index_unit(unit, x, y)
             return
         self._invalid_coordinates(location)
 
     def __iter__(self):
-        self.__start = [13,0]
-        return self
-    
-    def __next__(self):
-        location = self.__start
-        if location == [15,27]:
-            raise StopIteration
-        new_location = [location[0]+1, location[1]]
-        while not self.in_arena_bounds(new_location) and not location == [14,27]:
-            if new_location[0] == self.ARENA_SIZE:
-                new_location = [0, new_location[1]+1]
-            else:
-                new_location = [new_location[0]+1, new_location[1]]
-        self.__start = new_location
-        return location 
+        for x, y in ARENA_LOCATIONS:
+            yield [x, y]
+
+    def get_locations(self, half=None, player_index=None, occupied=None):
+        """Iterates over arena locations matching the given filters.
+        Every call returns an independent iterator, in the same order as iterating over the map.
+
+        Args:
+            half: 0 for the bottom half (your side), 1 for the top half (the enemy side). The whole arena if None.
+            player_index: Only locations holding a structure owned by this player, 0 for you 1 for the enemy.
+            occupied: True for only locations holding a structure, False for only locations without one. Any location if None.
+
+        Returns:
+            An iterator of [x, y] locations
+        """
+        if half is None:
+            locations = ARENA_LOCATIONS
+        elif half == 0:
+            locations = BOTTOM_HALF_LOCATIONS
+        elif half == 1:
+            locations = TOP_HALF_LOCATIONS
+        else:
+            self.warn("Invalid half {}. Use 0 for the bottom half or 1 for the top half.".format(half))
+            return iter(())
+
+        if player_index is None and occupied is None:
+            return ([x, y] for x, y in locations)
+        mask = self.get_occupancy(player_index=player_index) if player_index is not None else self._structure_mask
+        if occupied is False:
+            return ([x, y] for x, y in locations if not (mask >> (x * self.ARENA_SIZE + y)) & 1)
+        return ([x, y] for x, y in locations if (mask >> (x * self.ARENA_SIZE + y)) & 1)
 
     def __empty_grid(self):
         grid = []
@@ -75,6 +241,578 @@ class GameMap:
                 grid[x].append([])
         return grid
 
+    def _index_unit(self, unit, x, y):
+        """Records a unit that was put on the tile [x, y] in the occupancy bitboards and unit index"""
+        unit._game_map = self
+        unit._zobrist_key, unit._slot = self.__index(unit.unit_type, unit.player_index, unit.stationary, unit.upgraded,
+                                                     unit.pending_removal, unit.health, x, y)
+
+    def __index(self, unit_type, player_index, stationary, upgraded, pending_removal, health, x, y):
+        """Indexes a unit by its fields and returns its hash key and its entry in the unit arrays"""
+        slot = self._unit_arrays._add(unit_type, player_index, upgraded, pending_removal, health, x, y)
+        key = _zobrist_key(unit_type, player_index, upgraded, health, x, y)
+        self._zobrist = (self._zobrist + key) & ZOBRIST_MASK
+        locations = self._unit_index.setdefault((player_index, unit_type), {})
+        locations[x, y] = locations.get((x, y), 0) + 1
+        if stationary:
+            self.__cover(unit_type, player_index, upgraded, x, y, 1)
+            bit = 1 << (x * self.ARENA_SIZE + y)
+            self._structure_mask |= bit
+            self._type_masks[unit_type] = self._type_masks.get(unit_type, 0) | bit
+            if player_index == 0 or player_index == 1:
+                self._player_masks[player_index] |= bit
+                if upgraded:
+                    self._upgraded_masks[player_index] |= bit
+                if pending_removal:
+                    self._removal_masks[player_index] |= bit
+        return key, slot
+
+    def __cover(self, unit_type, player_index, upgraded, x, y, sign):
+        """Adds (sign 1) or removes (sign -1) a structure at [x, y] from the threat maps and attacker masks"""
+        stats = self._unit_stats.get((unit_type, upgraded))
+        if stats is None or stats.damage_i + stats.damage_f <= 0 or not (player_index == 0 or player_index == 1):
+            return
+        tiles = _coverage_table(stats.attackRange, self._attack_limit)[x * self.ARENA_SIZE + y]
+        attacker_masks = self._attacker_masks[1 - player_index]
+        bit = 1 << (x * self.ARENA_SIZE + y)
+        if sign > 0:
+            for tile in tiles:
+                attacker_masks[tile] |= bit
+        else:
+            for tile in tiles:
+                attacker_masks[tile] &= ~bit
+        if stats.damage_i > 0:
+            damage = sign * stats.damage_i
+            threat_map = self._threat_maps[1 - player_index]
+            for tile in tiles:
+                threat_map[tile] += damage
+
+    def _place_parsed_unit(self, unit_type, player_index, health, x, y):
+        """Indexes a unit from a serialized game state without creating a GameUnit for it.
+        The GameUnit is only created when its tile is first accessed.
+        """
+        if self._lazy_units is None:
+            self._lazy_units = {}
+        info = self._unit_info[unit_type]
+        stationary = info.get("unitCategory") == 0
+        if not health:
+            health = info.get("startHealth", 0)
+        _, slot = self.__index(unit_type, player_index, stationary, False, False, health, x, y)
+        self._lazy_units.setdefault(x * self.ARENA_SIZE + y, []).append([unit_type, player_index, health, False, False, slot])
+
+    def _mark_parsed_structure(self, x, y, upgrade=False, pending_removal=False):
+        """Upgrades or flags for removal the structure at [x, y] while parsing a serialized game state"""
+        bit = 1 << (x * self.ARENA_SIZE + y)
+        records = self._lazy_units.get(x * self.ARENA_SIZE + y) if self._lazy_units else None
+        if records is None:
+            unit = self.__tile(x, y)[0]
+            if upgrade:
+                unit.upgrade()
+            if pending_removal:
+                self._set_pending_removal(unit)
+            return
+        record = records[0]
+        unit_type, player_index, health, upgraded, _, slot = record
+        if upgrade and not upgraded:
+            old_key = _zobrist_key(unit_type, player_index, False, health, x, y)
+            new_key = _zobrist_key(unit_type, player_index, True, health, x, y)
+            self._zobrist = (self._zobrist - old_key + new_key) & ZOBRIST_MASK
+            record[3] = True
+            self._unit_arrays.upgraded[slot] = 1
+            self.__cover(unit_type, player_index, False, x, y, -1)
+            self.__cover(unit_type, player_index, True, x, y, 1)
+            if player_index == 0 or player_index == 1:
+                self._upgraded_masks[player_index] |= bit
+        if pending_removal:
+            record[4] = True
+            self._unit_arrays.pending_removal[slot] = 1
+            if player_index == 0 or player_index == 1:
+                self._removal_masks[player_index] |= bit
+
+    def __tile(self, x, y):
+        """Gets the unit list at [x, y], first creating the GameUnits of a lazily parsed tile"""
+        if self._lazy_units:
+            records = self._lazy_units.pop(x * self.ARENA_SIZE + y, None)
+            if records is not None:
+                units = []
+                for unit_type, player_index, health, upgraded, pending_removal, slot in records:
+                    unit = GameUnit(unit_type, self.config, player_index, health, x, y)
+                    if upgraded:
+                        unit.upgrade()
+                    unit.pending_removal = pending_removal
+                    unit._game_map = self
+                    unit._zobrist_key = _zobrist_key(unit_type, player_index, upgraded, unit.health, x, y)
+                    unit._slot = slot
+                    units.append(unit)
+                self.__set_tile(x, y, units)
+        return self.__map[x][y]
+
+    def _unindex_unit(self, unit, x, y):
+        """Removes a unit that left the tile [x, y] from the occupancy bitboards and unit index"""
+        if unit._game_map is self:
+            unit._game_map = None
+        self._zobrist = (self._zobrist - unit._zobrist_key) & ZOBRIST_MASK
+        self._unit_arrays._remove(unit._slot)
+        locations = self._unit_index.get((unit.player_index, unit.unit_type), {})
+        count = locations.get((x, y), 0)
+        if count > 1:
+            locations[x, y] = count - 1
+        elif count == 1:
+            del locations[x, y]
+        if unit.stationary:
+            # Use the upgrade status this map recorded, in case the unit was changed behind its back
+            self.__cover(unit.unit_type, unit.player_index, self._unit_arrays.upgraded[unit._slot] == 1, x, y, -1)
+            bit = ~(1 << (x * self.ARENA_SIZE + y))
+            self._structure_mask &= bit
+            self._type_masks[unit.unit_type] = self._type_masks.get(unit.unit_type, 0) & bit
+            if unit.player_index == 0 or unit.player_index == 1:
+                self._player_masks[unit.player_index] &= bit
+                self._upgraded_masks[unit.player_index] &= bit
+                self._removal_masks[unit.player_index] &= bit
+
+    def _upgrade_unit(self, unit):
+        """Upgrades a unit on this map, called by GameUnit.upgrade.
+        On a forked map the unit upgraded may be this map's copy of the unit passed in, which is returned.
+        """
+        x, y = unit.x, unit.y
+        for index, tile_unit in enumerate(self.__tile(x, y)):
+            if tile_unit is unit:
+                unit = self._own_tile(x, y)[index]
+                unit._stats = self._unit_stats[unit.unit_type, True]
+                if unit.stationary and not self._unit_arrays.upgraded[unit._slot]:
+                    self.__cover(unit.unit_type, unit.player_index, False, x, y, -1)
+                    self.__cover(unit.unit_type, unit.player_index, True, x, y, 1)
+                self.__unit_changed(unit)
+                if unit.stationary and (unit.player_index == 0 or unit.player_index == 1):
+                    self._upgraded_masks[unit.player_index] |= 1 << (x * self.ARENA_SIZE + y)
+                return unit
+        raise ValueError("Could not upgrade {}, it is not on the map".format(unit))
+
+    def __unit_changed(self, unit):
+        """Updates the board hash and unit arrays after a change to an indexed unit"""
+        key = _zobrist_key(unit.unit_type, unit.player_index, unit.upgraded, unit.health, unit.x, unit.y)
+        self._zobrist = (self._zobrist - unit._zobrist_key + key) & ZOBRIST_MASK
+        unit._zobrist_key = key
+        self._unit_arrays.health[unit._slot] = unit.health
+        self._unit_arrays.upgraded[unit._slot] = unit.upgraded
+
+    def zobrist_hash(self):
+        """Gets a 64 bit hash of the units on the board
+
+        The hash covers the location, type, owner, upgrade status and health of every unit,
+        and is kept up to date as units are added, removed, upgraded or have their health set
+        with set_unit_health, so reading it is free. Equal boards always have equal hashes,
+        in every process, which makes it suitable as a key for caching evaluations.
+
+        Returns:
+            An int between 0 and 2 ** 64 - 1
+        """
+        return self._zobrist
+
+    def get_unit_arrays(self):
+        """Gets every unit on the map as a UnitArrays, for computing aggregates without visiting every tile
+
+        The arrays are kept up to date as the map changes. Read them, but change units through
+        GameMap and GameState methods.
+
+        Returns:
+            The UnitArrays of this map
+        """
+        return self._unit_arrays
+
+    def get_threat_map(self, player_index):
+        """Gets the damage per frame a mobile unit would take from enemy structures, for every tile
+
+        The map is kept up to date as structures are added, removed and upgraded, so reading it is free.
+        It counts the same structures get_attackers returns, using each structure's own damage
+        and range, upgrades included. A structure's damage does not depend on its health, so health
+        is left out here, see get_durability_map for the health of the structures covering each tile.
+
+        Args:
+            player_index: The player whose mobile units are attacked, 0 for you 1 for the enemy
+
+        Returns:
+            A list of damage values indexed by x * ARENA_SIZE + y. Do not modify it.
+        """
+        return self._threat_maps[player_index]
+
+    def get_durability_map(self, player_index):
+        """Gets the total health of the enemy structures that can attack a mobile unit, for every tile
+
+        This is the health weighted companion of get_threat_map: the damage our units would have to deal
+        to silence every structure attacking a tile. It is computed in one pass over the unit arrays the
+        first time it is read for a board, and reused until a unit changes.
+
+        Args:
+            player_index: The player whose mobile units are attacked, 0 for you 1 for the enemy
+
+        Returns:
+            A list of health values indexed by x * ARENA_SIZE + y. Do not modify it.
+        """
+        cached = self._durability_maps.get(player_index)
+        if cached is not None and cached[0] == self._zobrist:
+            return cached[1]
+        durability_map = [0] * (self.ARENA_SIZE * self.ARENA_SIZE)
+        arrays = self._unit_arrays
+        unit_types = [unit_info.get("shorthand") for unit_info in self.config["unitInformation"]]
+        for slot in range(len(arrays.alive)):
+            if not arrays.alive[slot] or arrays.player_index[slot] != 1 - player_index:
+                continue
+            stats = self._unit_stats.get((unit_types[arrays.unit_type[slot]], arrays.upgraded[slot] == 1))
+            if stats is None or not stats.stationary or stats.damage_i + stats.damage_f <= 0:
+                continue
+            health = arrays.health[slot]
+            for tile in _coverage_table(stats.attackRange, self._attack_limit)[arrays.x[slot] * self.ARENA_SIZE + arrays.y[slot]]:
+                durability_map[tile] += health
+        self._durability_maps[player_index] = (self._zobrist, durability_map)
+        return durability_map
+
+    def get_threat(self, location, player_index):
+        """Gets the damage per frame a mobile unit at a location would take from enemy structures
+
+        Args:
+            location: The location of the mobile unit
+            player_index: The player who controls the mobile unit, 0 for you 1 for the enemy
+
+        Returns:
+            The total damage per frame of the enemy structures in range of the location
+        """
+        x, y = location
+        return self._threat_maps[player_index][x * self.ARENA_SIZE + y]
+
+    def get_attacker_locations(self, location, player_index):
+        """Gets the locations of the enemy structures that can attack a tile, without searching the area around it
+
+        The index behind this is kept up to date as structures are added, removed and upgraded.
+
+        Args:
+            location: The location of a hypothetical defender
+            player_index: The player who controls the defender, 0 for you 1 for the enemy
+
+        Returns:
+            The locations of the structures in range, ordered by x and then y
+        """
+        x, y = location
+        return self.get_locations_from_mask(self._attacker_masks[player_index][x * self.ARENA_SIZE + y])
+
+    def set_unit_health(self, unit, health):
+        """Sets the health of a unit on this map, keeping the board hash up to date
+
+        Args:
+            unit: A GameUnit on this map
+            health: The new health of the unit
+
+        Returns:
+            The unit that was changed. On a forked map this may be a copy of the unit passed in.
+        """
+        x, y = unit.x, unit.y
+        if not self.in_arena_bounds([x, y]):
+            self.warn("Could not set health of {}, it is not on the map".format(unit))
+            return
+        for index, tile_unit in enumerate(self.__tile(x, y)):
+            if tile_unit is unit:
+                unit = self._own_tile(x, y)[index]
+                unit.health = health
+                self.__unit_changed(unit)
+                return unit
+        self.warn("Could not set health of {}, it is not on the map".format(unit))
+
+    def _set_pending_removal(self, unit):
+        """Flags a structure on this map as pending removal"""
+        unit.pending_removal = True
+        self._unit_arrays.pending_removal[unit._slot] = 1
+        if unit.stationary and (unit.player_index == 0 or unit.player_index == 1):
+            self._removal_masks[unit.player_index] |= 1 << (unit.x * self.ARENA_SIZE + unit.y)
+
+    def get_unit_locations(self, player_index, unit_type=None):
+        """Gets the locations of a player's units, without scanning the map
+
+        Args:
+            player_index: The player whose units we want, 0 for you 1 for the enemy
+            unit_type: Only include units of this type. All unit types if None.
+
+        Returns:
+            A list of [x, y] locations, one per location even if several mobile units share it
+        """
+        # Several unit types can share a location, so gather them as dict keys to list each location once
+        locations = {}
+        for (owner, owner_type), type_locations in self._unit_index.items():
+            if owner == player_index and (unit_type is None or owner_type == unit_type):
+                locations.update(dict.fromkeys(type_locations))
+        return [[x, y] for x, y in locations]
+
+    def get_units(self, player_index, unit_type=None, rows=None, columns=None):
+        """Gets a player's units, without scanning the map
+
+        Args:
+            player_index: The player whose units we want, 0 for you 1 for the enemy
+            unit_type: Only include units of this type. All unit types if None.
+            rows: Only include units whose y coordinate is in this list. Any row if None.
+            columns: Only include units whose x coordinate is in this list. Any column if None.
+
+        Returns:
+            A list of GameUnits
+        """
+        rows = None if rows is None else set(rows)
+        columns = None if columns is None else set(columns)
+        units = []
+        for (owner, owner_type), type_locations in self._unit_index.items():
+            if not owner == player_index or not (unit_type is None or owner_type == unit_type):
+                continue
+            for x, y in type_locations:
+                if (rows is None or y in rows) and (columns is None or x in columns):
+                    units.extend(unit for unit in self.__owned_tile(x, y) if unit.player_index == owner and unit.unit_type == owner_type)
+        return units
+
+    def count_units(self, player_index, unit_type=None, rows=None, columns=None, structures_only=False):
+        """Counts a player's units, without scanning the map
+
+        Args:
+            player_index: The player whose units we want, 0 for you 1 for the enemy
+            unit_type: Only count units of this type. All unit types if None.
+            rows: Only count units whose y coordinate is in this list. Any row if None.
+            columns: Only count units whose x coordinate is in this list. Any column if None.
+            structures_only: Only count structures, leaving out mobile units
+
+        Returns:
+            The number of matching units
+        """
+        rows = None if rows is None else set(rows)
+        columns = None if columns is None else set(columns)
+        total = 0
+        for (owner, owner_type), type_locations in self._unit_index.items():
+            if not owner == player_index or not (unit_type is None or owner_type == unit_type):
+                continue
+            if structures_only and self._unit_info[owner_type].get("unitCategory") != 0:
+                continue
+            if rows is None and columns is None:
+                total += sum(type_locations.values())
+                continue
+            for (x, y), count in type_locations.items():
+                if (rows is None or y in rows) and (columns is None or x in columns):
+                    total += count
+        return total
+
+    def get_upgraded_locations(self, player_index):
+        """Gets the locations of a player's upgraded structures
+
+        Args:
+            player_index: The player whose structures we want, 0 for you 1 for the enemy
+
+        Returns:
+            A list of [x, y] locations
+        """
+        return self.get_locations_from_mask(self._upgraded_masks[player_index])
+
+    def get_pending_removal_locations(self, player_index):
+        """Gets the locations of a player's structures that are flagged for removal
+
+        Args:
+            player_index: The player whose structures we want, 0 for you 1 for the enemy
+
+        Returns:
+            A list of [x, y] locations
+        """
+        return self.get_locations_from_mask(self._removal_masks[player_index])
+
+    def _place_unit(self, unit):
+        """Appends an existing GameUnit to the tile at its own location.
+        Used internally by add_unit and when parsing the game state.
+        """
+        self._own_tile(unit.x, unit.y).append(unit)
+        self._index_unit(unit, unit.x, unit.y)
+
+    def _own_tile(self, x, y):
+        """Gets the unit list at [x, y] for modification.
+        On a forked map, a tile still shared with the map it was forked from is copied, units included, on first write.
+        """
+        self.__record_tile(x, y)
+        return self.__owned_tile(x, y)
+
+    def __owned_tile(self, x, y):
+        """Gets the unit list at [x, y], first copying it if this map is a fork that does not own the tile yet.
+        Tiles are copied on read as well as on write, so units handed out by a forked map are its own.
+        """
+        units = self.__tile(x, y)
+        if self._owned_tiles is not None and not self._owned_tiles[x * self.ARENA_SIZE + y]:
+            units = [copy.copy(unit) for unit in units]
+            for unit in units:
+                unit._game_map = self
+            self.__set_tile(x, y, units)
+        return units
+
+    def __detach_tile(self, x, y):
+        """Leaves forks that still share the tile [x, y] with this map a copy of its units, so this map can change its own"""
+        tile = x * self.ARENA_SIZE + y
+        if self._shared_tiles is not None and self._shared_tiles[tile]:
+            self._shared_tiles[tile] = 0
+            if self._owned_tiles is None or self._owned_tiles[tile]:
+                # Forks hold the same list object, so they see the copies while this map keeps its units on a new list
+                units = self.__map[x][y]
+                self.__map[x][y] = list(units)
+                units[:] = [copy.copy(unit) for unit in units]
+
+    def __record_tile(self, x, y):
+        """Called before a tile changes. Detaches the tile from forks, and inside a transaction saves
+        the units of the tile and the state of each unit the first time the tile changes.
+        """
+        self.__detach_tile(x, y)
+        if self._undo_marks:
+            recorded = self._undo_marks[-1][1]
+            tile = x * self.ARENA_SIZE + y
+            if tile not in recorded:
+                recorded.add(tile)
+                units = self.__tile(x, y)
+                states = [(unit.health, unit._stats, unit.pending_removal, unit.x, unit.y) for unit in units]
+                shared = self._owned_tiles is not None and not self._owned_tiles[tile]
+                self._undo_log.append((x, y, list(units), states, shared))
+
+    def _begin_changes(self):
+        """Starts recording changes so they can be undone with _rollback_changes. Calls can be nested."""
+        self._undo_marks.append((len(self._undo_log), set()))
+
+    def _rollback_changes(self):
+        """Restores every tile changed since the matching _begin_changes.
+        The units that were on a tile are put back and have their state restored, so references to them stay valid.
+        """
+        length, _ = self._undo_marks.pop()
+        while len(self._undo_log) > length:
+            x, y, units, states, shared = self._undo_log.pop()
+            self.__detach_tile(x, y)
+            for unit in self.__tile(x, y):
+                self._unindex_unit(unit, x, y)
+            if shared or (self._owned_tiles is not None and not self._owned_tiles[x * self.ARENA_SIZE + y]):
+                # The units belong to the map this one was forked from and must not change, so restore our own copies of them
+                units = [copy.copy(unit) for unit in units]
+            for unit, (health, stats, pending_removal, unit_x, unit_y) in zip(units, states):
+                unit.health, unit._stats, unit.pending_removal, unit.x, unit.y = health, stats, pending_removal, unit_x, unit_y
+            self.__set_tile(x, y, units)
+            for unit in units:
+                self._index_unit(unit, x, y)
+
+    def _commit_changes(self):
+        """Keeps the changes since the matching _begin_changes"""
+        _, recorded = self._undo_marks.pop()
+        if self._undo_marks:
+            self._undo_marks[-1][1].update(recorded)
+        else:
+            self._undo_log = []
+
+    def __set_tile(self, x, y, units):
+        """Puts a unit list that no other map holds on the tile [x, y]"""
+        self.__map[x][y] = units
+        if self._owned_tiles is not None:
+            self._owned_tiles[x * self.ARENA_SIZE + y] = 1
+        if self._shared_tiles is not None:
+            self._shared_tiles[x * self.ARENA_SIZE + y] = 0
+
+    def fork(self):
+        """Creates a copy of this map that can be edited without affecting the original.
+
+        The copy is cheap: tiles are shared between both maps, and the fork copies a tile, units
+        included, the first time it reads or changes it. The original keeps its own units, so
+        references to them stay valid: when it changes a tile the fork has not copied yet, it first
+        leaves the fork a copy of the units. Change units through GameUnit.upgrade and GameMap and
+        GameState methods rather than by setting their attributes.
+
+        Returns:
+            A new GameMap with the same units
+        """
+        forked = copy.copy(self)
+        forked.__map = [column[:] for column in self.__map]
+        forked._type_masks = dict(self._type_masks)
+        forked._player_masks = list(self._player_masks)
+        forked._upgraded_masks = list(self._upgraded_masks)
+        forked._removal_masks = list(self._removal_masks)
+        forked._unit_index = {key: dict(locations) for key, locations in self._unit_index.items()}
+        forked._unit_arrays = self._unit_arrays.copy()
+        forked._threat_maps = [list(threat_map) for threat_map in self._threat_maps]
+        forked._durability_maps = dict(self._durability_maps)
+        forked._attacker_masks = [list(attacker_masks) for attacker_masks in self._attacker_masks]
+        if self._lazy_units:
+            forked._lazy_units = dict(self._lazy_units)
+        forked._undo_log = []
+        forked._undo_marks = []
+        # From now on both maps share every tile, the fork owns none of them
+        self._shared_tiles = bytearray(b"\x01" * (self.ARENA_SIZE * self.ARENA_SIZE))
+        forked._owned_tiles = bytearray(self.ARENA_SIZE * self.ARENA_SIZE)
+        forked._shared_tiles = None
+        return forked
+
+    def structure_occupancy(self):
+        """Gets a bitmask of the tiles that hold a structure
+
+        Returns:
+            An int with bit (x * ARENA_SIZE + y) set for every location [x, y] that holds a structure.
+            Two maps with the same structure layout return the same value, so it can be used as a cache key.
+        """
+        return self._structure_mask
+
+    def get_occupancy(self, unit_type=None, player_index=None):
+        """Gets a bitmask of the tiles that hold structures matching the given filters
+
+        Args:
+            unit_type: Only include structures of this type, WALL, TURRET, etc. All structures if None.
+            player_index: Only include structures owned by this player, 0 for you 1 for the enemy. Both players if None.
+
+        Returns:
+            An int with bit (x * ARENA_SIZE + y) set for every matching location [x, y].
+            Masks can be combined with the usual bitwise operators.
+        """
+        if unit_type is None:
+            mask = self._structure_mask
+        else:
+            mask = self._type_masks.get(unit_type, 0)
+        if player_index is not None:
+            if not player_index == 0 and not player_index == 1:
+                self.warn("Player index {} is invalid. Player index should be 0 or 1.".format(player_index))
+                return 0
+            mask &= self._player_masks[player_index]
+        return mask
+
+    def count_structures(self, unit_type=None, player_index=None):
+        """Counts the structures matching the given filters
+
+        Args:
+            unit_type: Only count structures of this type, WALL, TURRET, etc. All structures if None.
+            player_index: Only count structures owned by this player, 0 for you 1 for the enemy. Both players if None.
+
+        Returns:
+            The number of matching structures
+        """
+        return bin(self.get_occupancy(unit_type, player_index)).count("1")
+
+    def is_blocked(self, location):
+        """Checks if a location holds a structure, without looking at the units on it
+
+        Args:
+            location: A map location
+
+        Returns:
+            True if there is a structure at the location, False otherwise (including out of bounds locations)
+        """
+        x, y = location
+        if x < 0 or y < 0 or x >= self.ARENA_SIZE or y >= self.ARENA_SIZE:
+            return False
+        return (self._structure_mask >> (int(x) * self.ARENA_SIZE + int(y))) & 1 == 1
+
+    def get_locations_from_mask(self, mask):
+        """Converts a bitmask from get_occupancy into a list of locations
+
+        Args:
+            mask: An int with bit (x * ARENA_SIZE + y) set for every location [x, y]
+
+        Returns:
+            The locations whose bit is set, ordered by x and then y
+        """
+        locations = []
+        while mask:
+            lowest = mask & -mask
+            x, y = divmod(lowest.bit_length() - 1, self.ARENA_SIZE)
+            locations.append([x, y])
+            mask ^= lowest
+        return locations
+
     def _invalid_coordinates(self, location):
         self.warn("{} is out of bounds.".format(str(location)))
 
@@ -163,15 +901,15 @@ class GameMap:
         """
         if not self.in_arena_bounds(location):
             self._invalid_coordinates(location)
+            return
         if player_index < 0 or player_index > 1:
             self.warn("Player index {} is invalid. Player index should be 0 or 1.".format(player_index))
 
         x, y = location
         new_unit = GameUnit(unit_type, self.config, player_index, None, location[0], location[1])
-        if not new_unit.stationary:
-            self.__map[x][y].append(new_unit)
-        else:
-            self.__map[x][y] = [new_unit]
+        if new_unit.stationary:
+            self.remove_unit(location)
+        self._place_unit(new_unit)
 
     def remove_unit(self, location):
         """Remove all units on the map in the given location.
@@ -184,9 +922,13 @@ class GameMap:
         """
         if not self.in_arena_bounds(location):
             self._invalid_coordinates(location)
-        
+            return
+
         x, y = location
-        self.__map[x][y] = []
+        self.__record_tile(x, y)
+        for unit in self.__tile(x, y):
+            self._unindex_unit(unit, x, y)
+        self.__set_tile(x, y, [])
 
     def get_locations_in_range(self, location, radius):
         """Gets locations in a circular area around a location
@@ -199,6 +941,14 @@ class GameMap:
             The locations that are within our search area
 
         """
+        table = self._range_tables.get(radius)
+        if table is not None:
+            x, y = location
+            if x == int(x) and y == int(y) and 0 <= x < self.ARENA_SIZE and 0 <= y < self.ARENA_SIZE:
+                locations = table[int(x) * self.ARENA_SIZE + int(y)]
+                if locations is not None:
+                    return [[i, j] for i, j in locations]
+
         if radius < 0 or radius > self.ARENA_SIZE:
             self.warn("Radius {} was passed to get_locations_in_range. Expected integer between 0 and {}".format(radius, self.ARENA_SIZE))
         if not self.in_arena_bounds(location):
@@ -207,7 +957,7 @@ class GameMap:
         x, y = location
         locations = []
         search_radius = math.ceil(radius)
-        getHitRadius = self.config["unitInformation"][0]['getHitRadius']
+        getHitRadius = self._hit_radius
         for i in range(int(x - search_radius), int(x + search_radius + 1)):
             for j in range(int(y - search_radius), int(y + search_radius + 1)):
                 new_location = [i, j]
@@ -216,6 +966,28 @@ class GameMap:
                     locations.append(new_location)
         return locations
 
+    def _range_mask(self, x, y, radius):
+        """Gets get_locations_in_range([x, y], radius) as a bitmask, or None if that result is not precomputed"""
+        masks = self._range_masks.get(radius)
+        if masks is None:
+            table = self._range_tables.get(radius)
+            if table is None:
+                return None
+            masks = _RANGE_MASKS.get((radius, self._hit_radius))
+            if masks is None:
+                masks = []
+                for locations in table:
+                    if locations is None:
+                        masks.append(None)
+                        continue
+                    mask = 0
+                    for i, j in locations:
+                        mask |= 1 << (i * self.ARENA_SIZE + j)
+                    masks.append(mask)
+                _RANGE_MASKS[(radius, self._hit_radius)] = masks
+            self._range_masks[radius] = masks
+        return masks[x * self.ARENA_SIZE + y]
+
     def distance_between_locations(self, location_1, location_2):
         """Euclidean distance
 
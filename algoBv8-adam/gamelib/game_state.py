@@ -1,11 +1,13 @@
+import copy
 import math
 import json
 import sys
+from contextlib import contextmanager
 
 from .navigation import ShortestPathFinder
-from .util import send_command, debug_write
+from .util import submit_commands, debug_write
 from .unit import GameUnit
-from .game_map import GameMap
+from .game_map import GameMap, BOTTOM_EDGE_LOCATIONS
 
 def is_stationary(unit_type):
     """
@@ -47,12 +49,15 @@ class GameState:
 
     """
 
-    def __init__(self, config, serialized_string):
+    def __init__(self, config, serialized_string, lazy=False):
         """ Setup a turns variables using arguments passed
 
         Args:
             * config (JSON): A json object containing information about the game
-            * serialized_string (string): A string containing information about the game state at the start of this turn
+            * serialized_string (string): A string containing information about the game state at the start of this turn,
+              or the dict it decodes to, as AlgoCore passes when parsed_messages is set
+            * lazy (bool): If true, the GameUnits on a tile are only created when the tile is first accessed.
+              Occupancy, the unit index and the board hash are still filled in right away.
 
         """
         self.serialized_string = serialized_string
@@ -91,19 +96,22 @@ class GameState:
 
         self.game_map = GameMap(self.config)
         self._shortest_path_finder = ShortestPathFinder()
+        self._path_cache = {}
+        self._path_cache_size = 4096
         self._build_stack = []
         self._deploy_stack = []
+        self._savepoints = []
         self._player_resources = [
                 {'SP': 0, 'MP': 0},  # player 0, which is you
                 {'SP': 0, 'MP': 0}]  # player 1, which is the opponent
-        self.__parse_state(serialized_string)
+        self.__parse_state(serialized_string, lazy)
 
-    def __parse_state(self, state_line):
+    def __parse_state(self, state_line, lazy=False):
         """
         Fills in map based on the serialized game state so that self.game_map[x,y] is a list of GameUnits at that location.
-        state_line is the game state as a json string.
+        state_line is the game state as a json string, or the dict it decodes to.
         """
-        state = json.loads(state_line)
+        state = json.loads(state_line) if isinstance(state_line, str) else state_line
 
         turn_info = state["turnInfo"]
         self.turn_number = int(turn_info[1])
@@ -123,8 +131,12 @@ class GameState:
         p1units = state["p1Units"]
         p2units = state["p2Units"]
 
-        self.__create_parsed_units(p1units, 0)
-        self.__create_parsed_units(p2units, 1)
+        if lazy:
+            self.__index_parsed_units(p1units, 0)
+            self.__index_parsed_units(p2units, 1)
+        else:
+            self.__create_parsed_units(p1units, 0)
+            self.__create_parsed_units(p2units, 1)
 
     def __create_parsed_units(self, units, player_number):
         """
@@ -141,13 +153,33 @@ class GameState:
                 if unit_type == REMOVE:
                     # Quick fix will deploy engine fix soon
                     if self.contains_stationary_unit([x,y]):
-                        self.game_map[x,y][0].pending_removal = True
+                        self.game_map._set_pending_removal(self.game_map[x,y][0])
                 elif unit_type == UPGRADE:
                     if self.contains_stationary_unit([x,y]):
                         self.game_map[x,y][0].upgrade()
                 else:
                     unit = GameUnit(unit_type, self.config, player_number, hp, x, y)
-                    self.game_map[x,y].append(unit)
+                    self.game_map._place_unit(unit)
+
+    def __index_parsed_units(self, units, player_number):
+        """
+        Helper function for __parse_state to add units to the map without creating GameUnits for them.
+        """
+        typedef = self.config.get("unitInformation")
+        game_map = self.game_map
+        for i, unit_types in enumerate(units):
+            unit_type = typedef[i].get("shorthand")
+            for uinfo in unit_types:
+                x, y = int(uinfo[0]), int(uinfo[1])
+                # This depends on RM and UP always being the last types to be processed
+                if unit_type == REMOVE:
+                    if game_map.is_blocked([x, y]):
+                        game_map._mark_parsed_structure(x, y, pending_removal=True)
+                elif unit_type == UPGRADE:
+                    if game_map.is_blocked([x, y]):
+                        game_map._mark_parsed_structure(x, y, upgrade=True)
+                else:
+                    game_map._place_parsed_unit(unit_type, player_number, float(uinfo[2]), x, y)
 
     def __resource_required(self, unit_type):
         return self.SP if is_stationary(unit_type) else self.MP
@@ -174,11 +206,118 @@ class GameState:
     def submit_turn(self):
         """Submit and end your turn.
             Must be called at the end of your turn or the algo will hang.
+
+        Returns:
+            True if the turn was sent. False if it was discarded because the turn was already submitted,
+            for example by AlgoCore's fallback watchdog after this turn ran too long.
         """
         build_string = json.dumps(self._build_stack)
         deploy_string = json.dumps(self._deploy_stack)
-        send_command(build_string)
-        send_command(deploy_string)
+        return submit_commands(build_string, deploy_string)
+
+    def fork(self):
+        """Creates a hypothetical copy of this game state.
+
+        Spawning, upgrading and removing in the copy does not affect this game state.
+        The copy shares the map tiles with this game state until it changes them, so creating
+        one costs much less than copy.deepcopy. The path cache is shared as well, since it is
+        keyed by structure layout.
+
+        Returns:
+            A new GameState
+        """
+        forked = copy.copy(self)
+        forked.game_map = self.game_map.fork()
+        forked._build_stack = list(self._build_stack)
+        forked._deploy_stack = list(self._deploy_stack)
+        forked._player_resources = [dict(resources) for resources in self._player_resources]
+        forked._savepoints = []
+        return forked
+
+    def board_hash(self):
+        """Gets a 64 bit hash of the units on the board, see GameMap.zobrist_hash
+
+        Returns:
+            An int between 0 and 2 ** 64 - 1
+        """
+        return self.game_map.zobrist_hash()
+
+    def get_unit_arrays(self):
+        """Gets every unit on the board as parallel arrays, see GameMap.get_unit_arrays
+
+        Returns:
+            A UnitArrays
+        """
+        return self.game_map.get_unit_arrays()
+
+    def memoize(self, table, evaluate, *key):
+        """Evaluates this game state, reusing an earlier result for an identical board if there is one
+
+        Keep the table between turns to reuse results across turns. The result is looked up by the
+        board hash and key, so key must include anything else evaluate depends on.
+
+        Args:
+            table: A TranspositionTable
+            evaluate: A function that takes this GameState and returns a result
+            key: Extra values that, together with the board, determine the result
+
+        Returns:
+            The result of evaluate for this board and key
+        """
+        full_key = (self.game_map.zobrist_hash(),) + key
+        result = table.get(full_key, table)
+        if result is table:
+            result = evaluate(self)
+            table.put(full_key, result)
+        return result
+
+    def begin(self):
+        """Starts a hypothetical edit of this game state.
+
+        Every change made by attempt_spawn, attempt_upgrade, attempt_remove, GameMap.add_unit and
+        GameMap.remove_unit after this call is recorded, and can be undone with rollback or kept
+        with commit. Transactions can be nested, each rollback or commit closes the latest begin.
+        """
+        self._savepoints.append((len(self._build_stack), len(self._deploy_stack),
+                                 [dict(resources) for resources in self._player_resources]))
+        self.game_map._begin_changes()
+
+    def rollback(self):
+        """Undoes every change since the latest begin, in time proportional to the number of changes.
+        """
+        if not self._savepoints:
+            self.warn("Called rollback without a matching begin")
+            return
+        build_length, deploy_length, resources = self._savepoints.pop()
+        del self._build_stack[build_length:]
+        del self._deploy_stack[deploy_length:]
+        self._player_resources = resources
+        self.game_map._rollback_changes()
+
+    def commit(self):
+        """Keeps every change since the latest begin.
+        """
+        if not self._savepoints:
+            self.warn("Called commit without a matching begin")
+            return
+        self._savepoints.pop()
+        self.game_map._commit_changes()
+
+    @contextmanager
+    def hypothetical(self):
+        """Context manager that rolls back every change made inside it.
+
+        Example::
+
+            with game_state.hypothetical():
+                game_state.attempt_spawn(WALL, [13, 5])
+                path = game_state.find_path_to_edge([13, 0])
+        """
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.rollback()
 
     def get_resource(self, resource_type, player_index = 0):
         """Gets a players resources
@@ -239,16 +378,19 @@ class GameState:
             return
 
         costs = self.type_cost(unit_type)
-        player_held = self.get_resources()
+        if costs[MP] <= 0 and costs[SP] <= 0:
+            self.warn("Invalid costs for unit, cost is 0 for both resources, returning 0")
+            return 0
+        return self.__count_affordable(costs, self.get_resources())
+
+    def __count_affordable(self, costs, player_held):
         if costs[MP] > 0 and costs[SP] > 0:
             return min(math.floor(player_held[SP] / costs[SP]), math.floor(player_held[MP] / costs[MP]))
         elif costs[MP] > 0:
             return math.floor(player_held[MP] / costs[MP])
         elif costs[SP] > 0:
             return math.floor(player_held[SP] / costs[SP])
-        else:
-            self.warn("Invalid costs for unit, cost is 0 for both resources, returning 0")
-            return 0
+        return 0
 
     def project_future_MP(self, turns_in_future=1, player_index=0, current_MP=None):
         """Predicts the number of MP we will have on a future turn
@@ -333,7 +475,7 @@ class GameState:
         stationary = is_stationary(unit_type)
         blocked = self.contains_stationary_unit(location) or (stationary and len(self.game_map[location[0],location[1]]) > 0)
         correct_territory = location[1] < self.HALF_ARENA
-        on_edge = location in (self.game_map.get_edge_locations(self.game_map.BOTTOM_LEFT) + self.game_map.get_edge_locations(self.game_map.BOTTOM_RIGHT))
+        on_edge = (location[0], location[1]) in BOTTOM_EDGE_LOCATIONS
 
         if self.enable_warnings:
             fail_reason = ""
@@ -435,7 +577,7 @@ class GameState:
             if location[1] < self.HALF_ARENA and self.contains_stationary_unit(location):
                 x, y = map(int, location)
                 existing_unit = None
-                for unit in self.game_map[x,y]:
+                for unit in self.game_map._own_tile(x, y):
                     if unit.stationary:
                         existing_unit = unit
 
@@ -452,6 +594,114 @@ class GameState:
                 self.warn("Could not upgrade a unit from {}. Location has no structures or is enemy territory.".format(location))
         return spawned_units
 
+    def apply_build_plan(self, plan, dry_run=False):
+        """Applies a list of spawn, upgrade and remove actions in order.
+
+        The outcome is the same as calling attempt_spawn, attempt_upgrade and attempt_remove for
+        each action in turn, but every action is checked in a single pass against a running resource
+        total and precomputed edge locations, and failures are reported in the results instead of
+        as warnings.
+
+        Args:
+            plan: A list of actions, each (unit_type, location) or (unit_type, location, num).
+                unit_type is a unit type to spawn, UPGRADE or REMOVE.
+            dry_run: If True, work out the results without changing this game state
+
+        Returns:
+            A dict with "results", one dict per action holding its "action", "location", the
+            "requested" and "succeeded" unit counts, its "cost" as [SP, MP] and the "reason" it
+            failed or None, and "cost", the total [SP, MP] spent by the plan.
+
+        """
+        if dry_run:
+            with self.hypothetical():
+                return self.apply_build_plan(plan)
+
+        game_map = self.game_map
+        held = self.get_resources()
+        type_costs = {}
+        results = []
+        total = [0, 0]
+        for action in plan:
+            unit_type, location = action[0], action[1]
+            num = action[2] if len(action) > 2 else 1
+            result = {"action": unit_type, "location": location, "requested": num, "succeeded": 0, "cost": [0, 0], "reason": None}
+            results.append(result)
+            x, y = location
+
+            if unit_type == REMOVE:
+                if y < self.HALF_ARENA and game_map.is_blocked(location):
+                    self._build_stack.append((REMOVE, int(x), int(y)))
+                    result["succeeded"] = 1
+                else:
+                    result["reason"] = "Location has no structures or is enemy territory."
+                continue
+
+            if unit_type == UPGRADE:
+                if not (y < self.HALF_ARENA and game_map.is_blocked(location)):
+                    result["reason"] = "Location has no structures or is enemy territory."
+                    continue
+                x, y = int(x), int(y)
+                index = max(i for i, unit in enumerate(game_map[x, y]) if unit.stationary)
+                unit = game_map[x, y][index]
+                if unit.upgraded or self.config["unitInformation"][UNIT_TYPE_TO_INDEX[unit.unit_type]].get("upgrade", None) is None:
+                    result["reason"] = "Unit can not be upgraded."
+                    continue
+                costs = self.type_cost(unit.unit_type, True)
+                if held[SP] < costs[SP] or held[MP] < costs[MP]:
+                    result["reason"] = "Not enough resources."
+                    continue
+                held[SP] -= costs[SP]
+                held[MP] -= costs[MP]
+                game_map._own_tile(x, y)[index].upgrade()
+                self._build_stack.append((UPGRADE, x, y))
+                result["succeeded"] = 1
+                result["cost"] = list(costs)
+                total[SP] += costs[SP]
+                total[MP] += costs[MP]
+                continue
+
+            if unit_type not in ALL_UNITS:
+                result["reason"] = "Invalid unit."
+                continue
+            if num < 1:
+                result["reason"] = "Requested fewer than one unit."
+                continue
+            if not game_map.in_arena_bounds(location):
+                result["reason"] = "Location invalid."
+                continue
+            costs = type_costs.get(unit_type)
+            if costs is None:
+                costs = type_costs[unit_type] = self.type_cost(unit_type)
+            stationary = is_stationary(unit_type)
+            if y >= self.HALF_ARENA:
+                result["reason"] = "Location in enemy territory."
+                continue
+            if not stationary and (x, y) not in BOTTOM_EDGE_LOCATIONS:
+                result["reason"] = "Information units must be deployed on the edge."
+                continue
+            stack = self._build_stack if stationary else self._deploy_stack
+            x, y = int(x), int(y)
+            for _ in range(num):
+                if game_map.is_blocked(location) or (stationary and len(game_map[x, y]) > 0):
+                    result["reason"] = "Location is blocked."
+                    break
+                if self.__count_affordable(costs, held) < 1:
+                    result["reason"] = "Not enough resources."
+                    break
+                held[SP] -= costs[SP]
+                held[MP] -= costs[MP]
+                game_map.add_unit(unit_type, location, 0)
+                stack.append((unit_type, x, y))
+                result["succeeded"] += 1
+            result["cost"] = [costs[SP] * result["succeeded"], costs[MP] * result["succeeded"]]
+            total[SP] += result["cost"][SP]
+            total[MP] += result["cost"][MP]
+
+        self._player_resources[0]["SP"] = held[SP]
+        self._player_resources[0]["MP"] = held[MP]
+        return {"results": results, "cost": total}
+
     def get_target_edge(self, start_location):
         """Gets the target edge given a starting location
 
@@ -479,6 +729,10 @@ class GameState:
         """Gets the path a unit at a given location would take. 
         If final point is not on an edge, it is a self destruct path
 
+        Paths are cached per structure layout for the rest of the turn. Editing the lists
+        returned by game_map[x, y] directly bypasses the layout tracking, use GameMap.add_unit
+        and GameMap.remove_unit to build hypothetical boards instead.
+
         Args:
             start_location: The location of a hypothetical unit
             target_edge: The edge the unit wants to reach. game_map.TOP_LEFT, game_map.BOTTOM_RIGHT, etc. Induced from start_location if None.
@@ -495,8 +749,60 @@ class GameState:
         if target_edge is None:
             target_edge = self.get_target_edge(start_location)
 
-        end_points = self.game_map.get_edge_locations(target_edge)
-        return self._shortest_path_finder.navigate_multiple_endpoints(start_location, end_points, self)
+        # Paths only depend on the structure layout, so changing the map through GameMap or
+        # attempt_spawn automatically moves lookups to a new key
+        key = (int(start_location[0]), int(start_location[1]), target_edge, self.game_map.structure_occupancy())
+        path = self._path_cache.get(key)
+        if path is None:
+            end_points = self.game_map.get_edge_locations(target_edge)
+            path = self.__cache_path(key, self._shortest_path_finder.navigate_multiple_endpoints(start_location, end_points, self))
+        return [[x, y] for x, y in path]
+
+    def find_paths_to_edges(self, start_locations, target_edge=None):
+        """Gets the paths units at several locations would take.
+        Equivalent to calling find_path_to_edge for every location, but all starts that
+        share a target edge are resolved from a single search of the map.
+
+        Args:
+            start_locations: A list of locations of hypothetical units
+            target_edge: The edge the units want to reach. Induced from each start location if None.
+
+        Returns:
+            A list with the path for each start location, in the same order as start_locations.
+            The entry is None if that start location is blocked.
+
+        """
+        paths = [None] * len(start_locations)
+        mask = self.game_map.structure_occupancy()
+        pending = {}
+        for index, start_location in enumerate(start_locations):
+            if self.contains_stationary_unit(start_location):
+                self.warn("Attempted to perform pathing from blocked starting location {}".format(start_location))
+                continue
+            edge = self.get_target_edge(start_location) if target_edge is None else target_edge
+            key = (int(start_location[0]), int(start_location[1]), edge, mask)
+            path = self._path_cache.get(key)
+            if path is None:
+                pending.setdefault(edge, []).append((index, key))
+            else:
+                paths[index] = [[x, y] for x, y in path]
+
+        for edge, requests in pending.items():
+            end_points = self.game_map.get_edge_locations(edge)
+            starts = [start_locations[index] for index, _ in requests]
+            found = self._shortest_path_finder.navigate_multiple_starts(starts, end_points, self)
+            for (index, key), path in zip(requests, found):
+                path = self.__cache_path(key, path)
+                paths[index] = [[x, y] for x, y in path]
+        return paths
+
+    def __cache_path(self, key, path):
+        if len(self._path_cache) >= self._path_cache_size:
+            # Evict the oldest entry
+            del self._path_cache[next(iter(self._path_cache))]
+        path = tuple((x, y) for x, y in path)
+        self._path_cache[key] = path
+        return path
 
     def contains_stationary_unit(self, location):
         """Check if a location is blocked, return structures unit if it is
@@ -508,8 +814,9 @@ class GameState:
             A structures unit if there is a stationary unit at the location, False otherwise
             
         """
-        if not self.game_map.in_arena_bounds(location):
-            self.warn('Checked for stationary unit outside of arena bounds')
+        if not self.game_map.is_blocked(location):
+            if not self.game_map.in_arena_bounds(location):
+                self.warn('Checked for stationary unit outside of arena bounds')
             return False
         x, y = map(int, location)
         for unit in self.game_map[x,y]:
@@ -614,6 +921,112 @@ class GameState:
                     target_x_distance = unit_x_distance
         return target
 
+    def get_targets(self, attacking_units):
+        """Returns the targets of many units at once, based on current map of the game board.
+
+        Gives the same result as calling get_target for each unit, but the tiles holding units are
+        found once for the whole batch, only occupied tiles in range are visited, and the targeting
+        priority is compared as a single sort key.
+
+        Args:
+            attacking_units: A list of GameUnits
+
+        Returns:
+            A list with the GameUnit each attacking unit would choose to attack, or None if it has no target.
+
+        """
+        game_map = self.game_map
+        # Bitmasks of the tiles holding structures and mobile units, for each owner
+        structure_masks = {}
+        mobile_masks = {}
+        for (owner, unit_type), locations in game_map._unit_index.items():
+            masks = structure_masks if is_stationary(unit_type) else mobile_masks
+            mask = masks.get(owner, 0)
+            for x, y in locations:
+                mask |= 1 << (x * self.ARENA_SIZE + y)
+            masks[owner] = mask
+
+        targets = []
+        for attacking_unit in attacking_units:
+            in_range = None
+            if isinstance(attacking_unit, GameUnit):
+                x, y = attacking_unit.x, attacking_unit.y
+                if x == int(x) and y == int(y) and 0 <= x < self.ARENA_SIZE and 0 <= y < self.ARENA_SIZE:
+                    in_range = game_map._range_mask(int(x), int(y), attacking_unit.attackRange)
+            if in_range is None:
+                targets.append(self.get_target(attacking_unit))
+                continue
+
+            candidates = 0
+            if attacking_unit.damage_f != 0:
+                for owner, mask in structure_masks.items():
+                    if owner != attacking_unit.player_index:
+                        candidates |= mask
+            if attacking_unit.damage_i != 0:
+                for owner, mask in mobile_masks.items():
+                    if owner != attacking_unit.player_index:
+                        candidates |= mask
+            targets.append(self.__best_target(attacking_unit, candidates & in_range))
+        return targets
+
+    def __best_target(self, attacking_unit, candidates):
+        """
+        Helper function for get_targets to pick the target of a unit among the units on the tiles in the candidates bitmask.
+        The priority is a key compared in order, where lower is better and the first unit found wins ties.
+        """
+        game_map = self.game_map
+        attacker_location = [attacking_unit.x, attacking_unit.y]
+        y_sign = 1 if attacking_unit.player_index == 0 else -1
+        target = None
+        target_key = None
+        for location in game_map.get_locations_from_mask(candidates):
+            for unit in game_map[location]:
+                if unit.player_index == attacking_unit.player_index or (attacking_unit.damage_f == 0 and is_stationary(unit.unit_type)) or (attacking_unit.damage_i == 0 and not(is_stationary(unit.unit_type))):
+                    continue
+                unit_key = (unit.stationary, game_map.distance_between_locations(location, attacker_location), unit.health,
+                            y_sign * unit.y, -abs(self.HALF_ARENA - 0.5 - unit.x))
+                if target_key is None or unit_key < target_key:
+                    target = unit
+                    target_key = unit_key
+        return target
+
+    def path_damage(self, path, player_index=0):
+        """Estimates the damage a mobile unit would take following a path, see GameMap.get_threat_map
+
+        Args:
+            path: A list of locations, such as one returned by find_path_to_edge
+            player_index: The player who controls the mobile unit, 0 for you 1 for the enemy
+
+        Returns:
+            The sum over the path of the damage per frame dealt by enemy structures in range
+        """
+        threat_map = self.game_map.get_threat_map(player_index)
+        return sum(threat_map[x * self.ARENA_SIZE + y] for x, y in path)
+
+    def __indexed_attackers(self, location, x, y, player_index):
+        """
+        get_attackers using the attacker index of GameMap for structures. Mobile units are few, so they are checked directly.
+        """
+        game_map = self.game_map
+        candidates = game_map._attacker_masks[player_index][x * self.ARENA_SIZE + y]
+        for (owner, unit_type), locations in game_map._unit_index.items():
+            if owner == player_index or not locations or is_stationary(unit_type):
+                continue
+            stats = game_map._unit_stats[unit_type, False]
+            if stats.damage_i + stats.damage_f <= 0:
+                continue
+            for i, j in locations:
+                distance = game_map.distance_between_locations(location, [i, j])
+                if distance < game_map._attack_limit and distance <= stats.attackRange:
+                    candidates |= 1 << (i * self.ARENA_SIZE + j)
+
+        attackers = []
+        for location_unit in game_map.get_locations_from_mask(candidates):
+            for unit in game_map[location_unit]:
+                if unit.damage_i + unit.damage_f > 0 and unit.player_index != player_index and game_map.distance_between_locations(location, location_unit) <= unit.attackRange:
+                    attackers.append(unit)
+        return attackers
+
     def get_attackers(self, location, player_index):
         """Gets the stationary units threatening a given location
 
@@ -631,6 +1044,10 @@ class GameState:
         if not self.game_map.in_arena_bounds(location):
             self.warn("Location {} is not in the arena bounds.".format(location))
 
+        x, y = location
+        if (player_index == 0 or player_index == 1) and x == int(x) and y == int(y) and self.game_map.in_arena_bounds(location):
+            return self.__indexed_attackers(location, int(x), int(y), player_index)
+
         attackers = []
         """
         Get locations in the range of TURRET units
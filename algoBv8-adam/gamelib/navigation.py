@@ -1,24 +1,48 @@
 import heapq
-import math
 import sys
-import queue
+from collections import deque
 from .util import debug_write
 
-class Node:
-    """A path-finding node
+"""
+Tiles are identified by a flat index, tile = x * ARENA_SIZE + y. The tables below
+are built once at import time and shared by every ShortestPathFinder.
+"""
+ARENA_SIZE = 28
+HALF_ARENA = 14
+TILE_COUNT = ARENA_SIZE * ARENA_SIZE
 
-    Attributes :
-        * visited_idealness (bool): Have we visited this node during the idealness search step?
-        * visited_validate (bool): Have we visited this node during the validation step?
-        * blocked (bool): Is there a structures at this node's location
-        * pathlength: The distance between this node and the target location
 
-    """
-    def __init__(self):
-        self.visited_idealness = False
-        self.visited_validate = False
-        self.blocked = False
-        self.pathlength = -1
+def _in_arena_bounds(x, y):
+    if x < 0 or y < 0 or x >= ARENA_SIZE or y >= ARENA_SIZE:
+        return False
+    if y < HALF_ARENA:
+        return HALF_ARENA - y - 1 <= x <= HALF_ARENA + y
+    return y - HALF_ARENA <= x <= ARENA_SIZE - 1 - (y - HALF_ARENA)
+
+
+TILE_X = tuple(tile // ARENA_SIZE for tile in range(TILE_COUNT))
+TILE_Y = tuple(tile % ARENA_SIZE for tile in range(TILE_COUNT))
+IN_ARENA = tuple(_in_arena_bounds(TILE_X[tile], TILE_Y[tile]) for tile in range(TILE_COUNT))
+ARENA_TILES = tuple(tile for tile in range(TILE_COUNT) if IN_ARENA[tile])
+
+
+def _neighbor_tiles(tile):
+    # Same order as the original [x, y + 1], [x, y - 1], [x + 1, y], [x - 1, y] neighbor list
+    x, y = TILE_X[tile], TILE_Y[tile]
+    neighbors = []
+    for nx, ny in ((x, y + 1), (x, y - 1), (x + 1, y), (x - 1, y)):
+        if _in_arena_bounds(nx, ny):
+            neighbors.append(nx * ARENA_SIZE + ny)
+    return tuple(neighbors)
+
+
+NEIGHBORS = tuple(_neighbor_tiles(tile) if IN_ARENA[tile] else () for tile in range(TILE_COUNT))
+
+
+def tile_id(location):
+    """Converts an [x, y] location to its flat tile index"""
+    return int(location[0]) * ARENA_SIZE + int(location[1])
+
 
 """
 This class helps with pathfinding. We guarantee the results will
@@ -28,18 +52,28 @@ code to maximise time efficiency
 class ShortestPathFinder:
     """Handles path-finding
 
+    The search state is kept in flat arrays indexed by tile id that are allocated once
+    and reused by every call, so a single ShortestPathFinder can answer many queries cheaply.
+
     Attributes :
         * HORIZONTAL (int): A constant representing a horizontal movement
         * VERTICAL (int): A constant representing a vertical movement
 
         * game_state (:obj: GameState): The current gamestate
-        * game_map (:obj: GameMap): The current gamemap
 
     """
     def __init__(self):
         self.HORIZONTAL = 1
         self.VERTICAL = 2
         self.initialized = False
+        self.game_state = None
+        self._blocked = bytearray(TILE_COUNT)
+        self._visited = bytearray(TILE_COUNT)
+        self._pathlength = [-1] * TILE_COUNT
+        self._pocket_pathlength = [-1] * TILE_COUNT
+        self._blocked_mask = None
+        self._edge_fields = {}
+        self.max_repairs = 16
 
     def initialize_map(self, game_state):
         """Initializes the map
@@ -47,14 +81,149 @@ class ShortestPathFinder:
         Args:
             game_state: A GameState object representing the gamestate we want to traverse
         """
-        #Initialize map 
         self.initialized = True
         self.game_state = game_state
-        self.game_map = [[Node() for x in range(self.game_state.ARENA_SIZE)] for y in range(self.game_state.ARENA_SIZE)]
+        self._blocked[:] = bytes(TILE_COUNT)
+        self._visited[:] = bytes(TILE_COUNT)
+        self._pathlength = [-1] * TILE_COUNT
+        self._pocket_pathlength[:] = [-1] * TILE_COUNT
+        self._blocked_mask = 0
+        self._edge_fields = {}
+
+    def _sync_map(self, game_state):
+        """Brings the blocked tiles and the stored edge distance fields up to date with the game map.
+
+        A few changed tiles are repaired in place, larger changes drop the stored fields
+        so they are flooded again the next time they are needed.
+        """
+        mask = game_state.game_map.structure_occupancy()
+        if not self.initialized or self._blocked_mask is None:
+            self.initialize_map(game_state)
+        self.game_state = game_state
+        changed = mask ^ self._blocked_mask
+        if changed:
+            tiles = []
+            while changed:
+                lowest = changed & -changed
+                tiles.append(lowest.bit_length() - 1)
+                changed ^= lowest
+            blocked = self._blocked
+            if len(tiles) > self.max_repairs:
+                self._edge_fields = {}
+                for tile in tiles:
+                    blocked[tile] ^= 1
+            else:
+                for tile in tiles:
+                    blocked[tile] ^= 1
+                    for (seeds, field) in self._edge_fields.values():
+                        if blocked[tile]:
+                            self._repair_blocked(tile, seeds, field)
+                        else:
+                            self._repair_unblocked(tile, seeds, field)
+            self._blocked_mask = mask
+        self._visited[:] = bytes(TILE_COUNT)
+        self._pocket_pathlength[:] = [-1] * TILE_COUNT
+
+    def _edge_field(self, end_tiles):
+        """Gets the distance field towards a set of end tiles, flooding it if it is not stored yet"""
+        key = tuple(end_tiles)
+        entry = self._edge_fields.get(key)
+        if entry is None:
+            field = [-1] * TILE_COUNT
+            self._validate(end_tiles, field)
+            entry = (frozenset(end_tiles), field)
+            self._edge_fields[key] = entry
+        return entry[1]
+
+    def _repair_unblocked(self, tile, seeds, field):
+        """Updates a distance field after tile stopped being blocked. Distances can only shrink."""
+        blocked = self._blocked
+        if tile not in seeds:
+            best = -1
+            for neighbor in NEIGHBORS[tile]:
+                distance = field[neighbor]
+                if not blocked[neighbor] and not distance == -1 and (best == -1 or distance + 1 < best):
+                    best = distance + 1
+            field[tile] = best
+            if best == -1:
+                return
+
+        current = deque([tile])
+        while current:
+            location = current.popleft()
+            next_pathlength = field[location] + 1
+            for neighbor in NEIGHBORS[location]:
+                if blocked[neighbor]:
+                    continue
+                distance = field[neighbor]
+                if distance == -1 or distance > next_pathlength:
+                    field[neighbor] = next_pathlength
+                    current.append(neighbor)
+
+    def _repair_blocked(self, tile, seeds, field):
+        """Updates a distance field after tile became blocked. Distances can only grow.
+
+        Only the tiles whose every shortest route went through tile are reset and settled again
+        from the boundary of that region, the rest of the field is left untouched.
+        """
+        blocked = self._blocked
+        old_pathlength = field[tile]
+        if tile not in seeds:
+            field[tile] = -1
+        if old_pathlength == -1:
+            return
+
+        # Find the region that lost all of its support. Tiles are visited in order of distance,
+        # so every affected tile one step closer to the edge is known before it is needed.
+        affected = {tile}
+        order = []
+        current = deque([(tile, old_pathlength)])
+        while current:
+            location, distance = current.popleft()
+            for neighbor in NEIGHBORS[location]:
+                if blocked[neighbor] or neighbor in affected or not field[neighbor] == distance + 1:
+                    continue
+                supported = False
+                for support in NEIGHBORS[neighbor]:
+                    if not blocked[support] and support not in affected and field[support] == distance:
+                        supported = True
+                        break
+                if not supported:
+                    affected.add(neighbor)
+                    order.append(neighbor)
+                    current.append((neighbor, distance + 1))
+
+        if not order:
+            return
+        for location in order:
+            field[location] = -1
+
+        # Settle the region again from its boundary
+        frontier = []
+        for location in order:
+            best = -1
+            for neighbor in NEIGHBORS[location]:
+                distance = field[neighbor]
+                if not blocked[neighbor] and not distance == -1 and (best == -1 or distance + 1 < best):
+                    best = distance + 1
+            if not best == -1:
+                frontier.append((best, location))
+        heapq.heapify(frontier)
+        while frontier:
+            distance, location = heapq.heappop(frontier)
+            if not field[location] == -1 and field[location] <= distance:
+                continue
+            field[location] = distance
+            for neighbor in NEIGHBORS[location]:
+                if neighbor in affected and not blocked[neighbor] and (field[neighbor] == -1 or field[neighbor] > distance + 1):
+                    heapq.heappush(frontier, (distance + 1, neighbor))
 
     def navigate_multiple_endpoints(self, start_point, end_points, game_state):
         """Finds the path a unit would take to reach a set of endpoints
 
+        The distance field towards end_points is kept between calls. When the structure
+        layout changes by a few tiles, only the part of the field that depends on them is repaired.
+
         Args:
             * start_point: The starting location of the unit
             * end_points: The end points of the unit, should be a list of edge locations
@@ -68,44 +237,80 @@ class ShortestPathFinder:
         if game_state.contains_stationary_unit(start_point):
             return
 
-        #Initialize map 
-        self.initialize_map(game_state)
-        #Fill in walls
-        for location in self.game_state.game_map:
-            if self.game_state.contains_stationary_unit(location):
-                self.game_map[location[0]][location[1]].blocked = True
-        #Do pathfinding
-        ideal_endpoints = self._idealness_search(start_point, end_points)
-        self._validate(ideal_endpoints, end_points)
-        return self._get_path(start_point, end_points)
-
-    def _idealness_search(self, start, end_points):
+        self._sync_map(game_state)
+        return self._navigate(tile_id(start_point), end_points)
+
+    def navigate_multiple_starts(self, start_points, end_points, game_state):
+        """Finds the paths units at several locations would take to reach the same set of endpoints
+
+        The distance field towards end_points is shared by every start point that can reach
+        the edge. Start points boxed into a pocket share one field per pocket.
+
+        Args:
+            * start_points: A list of starting locations
+            * end_points: The end points of the units, should be a list of edge locations
+            * game_state: The current game state
+
+        Returns:
+            A list with the path for each start point, in the same order as start_points.
+            The entry is None if the start point is blocked by a structure.
+
         """
-        Finds the most ideal tile in our 'pocket' of pathable space. 
+        self._sync_map(game_state)
+        paths = []
+        for start_point in start_points:
+            if not _in_arena_bounds(int(start_point[0]), int(start_point[1])) or self._blocked[tile_id(start_point)]:
+                paths.append(None)
+            else:
+                paths.append(self._navigate(tile_id(start_point), end_points))
+        return paths
+
+    def _navigate(self, start, end_points):
+        """Gets the path from an unblocked start tile, the map must be synced first"""
+        end_tiles = [tile_id(location) for location in end_points]
+        direction = self._get_direction_from_endpoints(end_points)
+        edge_pathlength = self._edge_field(end_tiles)
+        if not edge_pathlength[start] == -1:
+            # The edge is reachable, so the edge is the ideal tile
+            self._pathlength = edge_pathlength
+            return self._get_path(start, direction, edge_pathlength)
+
+        # Self destruct path. Pockets are disjoint, so one array holds the field of every pocket
+        pocket_pathlength = self._pocket_pathlength
+        if pocket_pathlength[start] == -1:
+            ideal_tile = self._idealness_search(start, frozenset(end_tiles), direction)
+            self._validate([ideal_tile], pocket_pathlength)
+        self._pathlength = pocket_pathlength
+        return self._get_path(start, direction, pocket_pathlength)
+
+    def _idealness_search(self, start, end_tiles, direction):
+        """
+        Finds the most ideal tile in our 'pocket' of pathable space.
         The edge if it is available, or the best self destruct location otherwise
         """
-        current = queue.Queue()
-        current.put(start)
-        best_idealness = self._get_idealness(start, end_points)
-        self.game_map[start[0]][start[1]].visited_idealness = True
+        blocked = self._blocked
+        visited = self._visited
+        current = deque([start])
+        best_idealness = self._get_idealness(start, end_tiles, direction)
+        visited[start] = 1
         most_ideal = start
 
-        while not current.empty():
-            search_location = current.get()
-            for neighbor in self._get_neighbors(search_location):
-                if not self.game_state.game_map.in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
+        while current and best_idealness != sys.maxsize:
+            search_location = current.popleft()
+            for neighbor in NEIGHBORS[search_location]:
+                # Tiles that were already visited have already been compared against the best idealness
+                if blocked[neighbor] or visited[neighbor]:
                     continue
+                visited[neighbor] = 1
+                current.append(neighbor)
 
-                x, y = neighbor
-                current_idealness = self._get_idealness(neighbor, end_points)
-
+                current_idealness = self._get_idealness(neighbor, end_tiles, direction)
                 if current_idealness > best_idealness:
                     best_idealness = current_idealness
                     most_ideal = neighbor
-
-                if not self.game_map[x][y].visited_idealness and not self.game_map[x][y].blocked:
-                    self.game_map[x][y].visited_idealness = True
-                    current.put(neighbor)
+                    # An edge tile cannot be beaten, stop searching
+                    if best_idealness == sys.maxsize:
+                        break
 
         return most_ideal
 
@@ -116,10 +321,10 @@ class ShortestPathFinder:
         return [[x, y + 1], [x, y - 1], [x + 1, y], [x - 1, y]]
 
     def _get_direction_from_endpoints(self, end_points):
-        """Prints a message to the games debug output
+        """Gets the direction of an edge
 
         Args:
-            * end_points: A set of endpoints, should be an edge 
+            * end_points: A set of endpoints, should be an edge
 
         Returns:
             A direction [x,y] representing the edge. For example, [1,1] for the top right and [-1, 1] for the top left
@@ -128,163 +333,123 @@ class ShortestPathFinder:
         point = end_points[0]
         x, y = point
         direction = [1, 1]
-        if x < self.game_state.HALF_ARENA:
+        if x < HALF_ARENA:
            direction[0] = -1
-        if y < self.game_state.HALF_ARENA:
+        if y < HALF_ARENA:
             direction[1] = -1
         return direction
 
-    def _get_idealness(self, location, end_points):
+    def _get_idealness(self, tile, end_tiles, direction):
         """Get the idealness of a tile, the reachable tile the unit most wants to path to.
-        Better self destruct locations are more ideal. The endpoints are perfectly ideal. 
+        Better self destruct locations are more ideal. The endpoints are perfectly ideal.
 
         Returns:
-            A location the unit will attempt to reach
+            A number, the higher the more ideal
         """
-        if location in end_points:
+        if tile in end_tiles:
             return sys.maxsize
 
-        direction = self._get_direction_from_endpoints(end_points)
-
-        idealness = 0
+        x, y = TILE_X[tile], TILE_Y[tile]
         if direction[1] == 1:
-            idealness += 28 * location[1]
-        else: 
-            idealness += 28 * (27 - location[1])
+            idealness = 28 * y
+        else:
+            idealness = 28 * (27 - y)
         if direction[0] == 1:
-            idealness += location[0]
-        else: 
-            idealness += (27 - location[0])
+            idealness += x
+        else:
+            idealness += (27 - x)
 
         return idealness
 
-    def _validate(self, ideal_tile, end_points):
-        """Breadth first search of the grid, setting the pathlengths of each node
+    def _validate(self, seeds, pathlength):
+        """Breadth first search of the grid from the seed tiles, setting the pathlengths of each tile
 
         """
-        #VALIDATION
-        #Add our most ideal tiles to current
-        current = queue.Queue()
-        if ideal_tile in end_points:
-            for location in end_points:
-               current.put(location)
-               #Set current pathlength to 0
-               self.game_map[location[0]][location[1]].pathlength = 0
-               self.game_map[location[0]][location[1]].visited_validate = True
-        else:
-            current.put(ideal_tile)
-            self.game_map[ideal_tile[0]][ideal_tile[1]].pathlength = 0
-            self.game_map[ideal_tile[0]][ideal_tile[1]].visited_validate = True
-
-        #While current is not empty
-        while not current.empty():
-            current_location = current.get()
-            current_node = self.game_map[current_location[0]][current_location[1]]
-            for neighbor in self._get_neighbors(current_location):
-                if not self.game_state.game_map.in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
+        blocked = self._blocked
+        for tile in seeds:
+            pathlength[tile] = 0
+        current = deque(seeds)
+
+        while current:
+            current_location = current.popleft()
+            # Blocked endpoints are valid targets but can't be walked through
+            if blocked[current_location]:
+                continue
+            next_pathlength = pathlength[current_location] + 1
+            for neighbor in NEIGHBORS[current_location]:
+                if blocked[neighbor] or pathlength[neighbor] != -1:
                     continue
+                pathlength[neighbor] = next_pathlength
+                current.append(neighbor)
 
-                neighbor_node = self.game_map[neighbor[0]][neighbor[1]]
-                if not neighbor_node.visited_validate and not current_node.blocked:
-                    neighbor_node.pathlength = current_node.pathlength + 1
-                    neighbor_node.visited_validate = True
-                    current.put(neighbor)
-
-        #debug_write("Print after validate")
-        #self.print_map()
-        return
-
-    def _get_path(self, start_point, end_points):
+    def _get_path(self, start, direction, pathlength):
         """Once all nodes are validated, and a target is found, the unit can path to its target
 
         """
-        #GET THE PATH
-        path = [start_point]
-        current = start_point
+        path = [[TILE_X[start], TILE_Y[start]]]
+        current = start
         move_direction = 0
 
-        while not self.game_map[current[0]][current[1]].pathlength == 0:
-            #debug_write("current tile {} has cost {}".format(current, self.game_map[current[0]][current[1]].pathlength))
-            next_move = self._choose_next_move(current, move_direction, end_points)
-            #debug_write(next_move)
+        while not pathlength[current] == 0:
+            next_move = self._choose_next_move(current, move_direction, direction, pathlength)
 
-            if current[0] == next_move[0]:
+            if TILE_X[current] == TILE_X[next_move]:
                 move_direction = self.VERTICAL
             else:
                 move_direction = self.HORIZONTAL
-            path.append(next_move)
+            path.append([TILE_X[next_move], TILE_Y[next_move]])
             current = next_move
-        
-        #debug_write(path)
+
         return path
-  
-    def _choose_next_move(self, current_point, previous_move_direction, end_points):
+
+    def _choose_next_move(self, current_point, previous_move_direction, direction, pathlength):
         """Given the current location and adjacent locations, return the best 'next step' for a given unit to take
         """
-        neighbors = self._get_neighbors(current_point)
-        #debug_write("Unit at {} previously moved {} and has these neighbors {}".format(current_point, previous_move_direction, neighbors))
-
+        blocked = self._blocked
         ideal_neighbor = current_point
-        best_pathlength = self.game_map[current_point[0]][current_point[1]].pathlength
-        for neighbor in neighbors:
-            #debug_write("Comparing champ {} and contender {}".format(ideal_neighbor, neighbor))
-            if not self.game_state.game_map.in_arena_bounds(neighbor) or self.game_map[neighbor[0]][neighbor[1]].blocked:
+        best_pathlength = pathlength[current_point]
+        for neighbor in NEIGHBORS[current_point]:
+            if blocked[neighbor]:
                 continue
 
-            new_best = False
-            x, y = neighbor
-            current_pathlength = self.game_map[x][y].pathlength
-
+            current_pathlength = pathlength[neighbor]
             #Filter by pathlength
             if current_pathlength > best_pathlength:
                 continue
-            elif current_pathlength < best_pathlength:
-                #debug_write("Contender has better pathlength at {} vs champs {}".format(current_pathlength, best_pathlength))
-                new_best = True
-
             #Filter by direction based on prev move
-            if not new_best and not self._better_direction(current_point, neighbor, ideal_neighbor, previous_move_direction, end_points):
+            if current_pathlength == best_pathlength and not self._better_direction(current_point, neighbor, ideal_neighbor, previous_move_direction, direction):
                 continue
 
             ideal_neighbor = neighbor
             best_pathlength = current_pathlength
 
-        #debug_write("Gave unit at {} new tile {}".format(current_point, ideal_neighbor))
         return ideal_neighbor
 
-    def _better_direction(self, prev_tile, new_tile, prev_best, previous_move_direction, end_points):
+    def _better_direction(self, prev_tile, new_tile, prev_best, previous_move_direction, direction):
         """Compare two tiles and return True if the unit would rather move to the new one
 
         """
         #True if we are moving in a different direction than prev move and prev is not
         #If we previously moved horizontal, and now one of our options has a different x position then the other (the two options are not up/down)
-        if previous_move_direction == self.HORIZONTAL and not new_tile[0] == prev_best[0]:
+        if previous_move_direction == self.HORIZONTAL and not TILE_X[new_tile] == TILE_X[prev_best]:
             #We want to go up now. If we have not changed our y, we are not going up
-            if prev_tile[1] == new_tile[1]:
-                return False 
-            return True
-        if previous_move_direction == self.VERTICAL and not new_tile[1] == prev_best[1]:
-            if prev_tile[0] == new_tile[0]:
-                #debug_write("contender {} has the same x coord as prev tile {} so we will keep best move {}".format(new_tile, prev_tile, prev_best))
-                return False
-            return True
-        if previous_move_direction == 0: 
-            if prev_tile[1] == new_tile[1]: 
-                return False
-            return True
-        
-        #To make it here, both moves are on the same axis 
-        direction = self._get_direction_from_endpoints(end_points)
-        if new_tile[1] == prev_best[1]: #If they both moved horizontal...
-            if direction[0] == 1 and new_tile[0] > prev_best[0]: #If we moved right and right is our direction, we moved towards our direction
-                return True 
-            if direction[0] == -1 and new_tile[0] < prev_best[0]: #If we moved left and left is our direction, we moved towards our direction
-                return True 
-            return False 
-        if new_tile[0] == prev_best[0]: #If they both moved vertical...
-            if direction[1] == 1 and new_tile[1] > prev_best[1]: #If we moved up and up is our direction, we moved towards our direction
+            return not TILE_Y[prev_tile] == TILE_Y[new_tile]
+        if previous_move_direction == self.VERTICAL and not TILE_Y[new_tile] == TILE_Y[prev_best]:
+            return not TILE_X[prev_tile] == TILE_X[new_tile]
+        if previous_move_direction == 0:
+            return not TILE_Y[prev_tile] == TILE_Y[new_tile]
+
+        #To make it here, both moves are on the same axis
+        if TILE_Y[new_tile] == TILE_Y[prev_best]: #If they both moved horizontal...
+            if direction[0] == 1 and TILE_X[new_tile] > TILE_X[prev_best]: #If we moved right and right is our direction, we moved towards our direction
+                return True
+            if direction[0] == -1 and TILE_X[new_tile] < TILE_X[prev_best]: #If we moved left and left is our direction, we moved towards our direction
+                return True
+            return False
+        if TILE_X[new_tile] == TILE_X[prev_best]: #If they both moved vertical...
+            if direction[1] == 1 and TILE_Y[new_tile] > TILE_Y[prev_best]: #If we moved up and up is our direction, we moved towards our direction
                 return True
-            if direction[1] == -1 and new_tile[1] < prev_best[1]: #If we moved down and down is our direction, we moved towards our direction
+            if direction[1] == -1 and TILE_Y[new_tile] < TILE_Y[prev_best]: #If we moved down and down is our direction, we moved towards our direction
                 return True
             return False
         return True
@@ -297,11 +462,11 @@ class ShortestPathFinder:
             debug_write("Attempted to print_map before pathfinder initialization. Use 'this_object.initialize_map(game_state)' to initialize the map first")
             return
 
-        for y in range(28):
-            for x in range(28):
-                node = self.game_map[x][28 - y - 1]
-                if not node.blocked and not node.pathlength == -1:
-                    self._print_justified(node.pathlength)
+        for y in range(ARENA_SIZE):
+            for x in range(ARENA_SIZE):
+                tile = x * ARENA_SIZE + (ARENA_SIZE - y - 1)
+                if not self._blocked[tile] and not self._pathlength[tile] == -1:
+                    self._print_justified(self._pathlength[tile])
                 else:
                     sys.stderr.write("   ")
             debug_write("")
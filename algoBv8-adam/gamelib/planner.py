@@ -0,0 +1,202 @@
+import math
+import random
+import time
+from .game_map import BOTTOM_EDGE_LOCATIONS
+
+MAX_REPEATED_DRAWS = 500
+
+
+class AttackPlanner:
+    """Searches for a good mobile unit attack until a deadline, keeping the best plan found so far
+
+    Candidate plans are sampled at random: one or two mobile unit types spawned on one edge location,
+    in counts we can afford now, or after saving MP for a few turns as predicted by project_future_MP.
+    Each plan is scored with a quick estimate rather than a full simulation. A stack of units takes
+    the damage per frame of the turrets along its path (see GameState.path_damage) for every frame it
+    spends on a tile, and the units whose pooled health outlasts that damage breach. The score is the
+    expected breach damage per turn spent saving, so a plan that waits has to be worth the wait.
+
+    The search can be stopped at any time: every sample checks the deadline first, and best always
+    holds the best plan scored so far.
+
+    Attributes :
+        * game_state (GameState): The board being attacked. It is not modified.
+        * unit_types (list): The mobile unit types plans are made of
+        * max_wait (int): The most turns a plan may save MP for
+        * best (dict): The best plan found so far, see search, or None before any plan is scored
+        * samples (int): The number of plans scored so far
+
+    """
+    def __init__(self, game_state, unit_types=None, max_wait=2, seed=None):
+        """Prepares a search over attacks against the current board
+
+        Args:
+            game_state: The board being attacked
+            unit_types: The mobile unit types to use. Scouts, demolishers and interceptors if None.
+            max_wait: The most turns a plan may save MP for before attacking
+            seed: Seed for sampling plans, so searches can be repeated
+
+        """
+        self.game_state = game_state
+        config = game_state.config
+        if unit_types is None:
+            unit_types = [config["unitInformation"][index]["shorthand"] for index in (3, 4, 5)]
+        self.unit_types = list(unit_types)
+        self.max_wait = max_wait
+        self.best = None
+        self.samples = 0
+        self.__random = random.Random(seed)
+        self.__unit_info = {info.get("shorthand"): info for info in config["unitInformation"]}
+        self.__scored = set()
+
+        game_map = game_state.game_map
+        self.__locations = [list(location) for location in sorted(BOTTOM_EDGE_LOCATIONS)
+                            if not game_state.contains_stationary_unit(location)]
+        mp = game_state.get_resource(game_state.MP)
+        self.__budgets = [mp] + [game_state.project_future_MP(turns) for turns in range(1, max_wait + 1)]
+        self.__paths = {}
+        self.__edges = {}
+        for edge in (game_map.TOP_LEFT, game_map.TOP_RIGHT):
+            self.__edges[edge] = {tuple(location) for location in game_map.get_edge_locations(edge)}
+
+    def deadline_from_config(self, time_fraction=0.5, start=None):
+        """Gets a deadline a fraction of the way into the soft turn time limit
+
+        Args:
+            time_fraction: The fraction of timingAndReplay.waitTimeBotSoft the search may use
+            start: The time.monotonic() time the turn started. Now if None.
+
+        Returns:
+            The deadline, comparable with time.monotonic()
+        """
+        soft_limit = self.game_state.config.get("timingAndReplay", {}).get("waitTimeBotSoft", 5000) / 1000
+        return (time.monotonic() if start is None else start) + soft_limit * time_fraction
+
+    def search(self, deadline=None, max_samples=None):
+        """Scores candidate plans until the deadline passes or enough plans have been scored
+
+        The single type plans that send as many units as we can afford right now are scored first,
+        so even a short search compares every spawn location.
+
+        Args:
+            deadline: Stop once time.monotonic() reaches this. Half of the soft time limit from now if None.
+            max_samples: Stop after scoring this many plans. No limit if None.
+
+        Returns:
+            The best plan found, a dict holding the (unit_type, [x, y], num) spawns under "units", the number of
+            turns to save MP for under "wait", the expected "breaches", the "score" and the MP "cost".
+            None if no plan was scored.
+
+        """
+        if deadline is None:
+            deadline = self.deadline_from_config()
+        if not self.__locations or not self.__budgets:
+            return self.best
+
+        seeded = []
+        for unit_type in self.unit_types:
+            num = self.game_state.number_affordable(unit_type)
+            if num > 0:
+                seeded.extend([(unit_type, location, num)] for location in self.__locations)
+        samples = self.samples
+        repeats = 0
+        # Stop early once random draws keep landing on plans that were already scored
+        while repeats < MAX_REPEATED_DRAWS and (max_samples is None or self.samples - samples < max_samples):
+            if time.monotonic() >= deadline:
+                break
+            if seeded:
+                wait, units = 0, seeded.pop()
+            else:
+                wait, units = self.__sample()
+            if units and self.__consider(wait, units):
+                repeats = 0
+            else:
+                repeats += 1
+        return self.best
+
+    def execute(self, game_state=None):
+        """Spawns the best plan if it attacks this turn
+
+        Args:
+            game_state: The GameState to spawn in. The one the planner was created with if None.
+
+        Returns:
+            The number of units spawned, 0 when there is no plan or the best plan is to save MP
+        """
+        game_state = self.game_state if game_state is None else game_state
+        if self.best is None or self.best["wait"] > 0:
+            return 0
+        return sum(game_state.attempt_spawn(unit_type, location, num) for unit_type, location, num in self.best["units"])
+
+    def estimate(self, units):
+        """Estimates the breaches of mobile units spawned against the current board
+
+        Args:
+            units: A list of (unit_type, [x, y], num) spawns
+
+        Returns:
+            The expected number of units that reach the enemy edge, and the health the enemy loses from them
+        """
+        breaches = 0
+        damage_dealt = 0
+        for unit_type, location, num in units:
+            path, damage_per_frame = self.__path(location)
+            if not path or (path[-1][0], path[-1][1]) not in self.__edges[self.game_state.get_target_edge(location)]:
+                continue
+            info = self.__unit_info[unit_type]
+            health = info.get("startHealth", 0)
+            if health <= 0:
+                continue
+            damage = damage_per_frame / info.get("speed", 1)
+            survivors = min(num, max(0, math.ceil((num * health - damage) / health)))
+            breaches += survivors
+            damage_dealt += survivors * info.get("playerBreachDamage", 1)
+        return breaches, damage_dealt
+
+    def __consider(self, wait, units):
+        """Scores a plan, replacing the best plan if it does better. Returns False if the plan was already scored."""
+        key = (wait, tuple((unit_type, location[0], location[1], num) for unit_type, location, num in units))
+        if key in self.__scored:
+            return False
+        self.samples += 1
+        breaches, damage = self.estimate(units)
+        score = damage / (wait + 1)
+        cost = sum(self.game_state.type_cost(unit_type)[self.game_state.MP] * num for unit_type, _, num in units)
+        self.__scored.add(key)
+        plan = {"units": units, "wait": wait, "breaches": breaches, "score": score, "cost": cost}
+        if self.best is None or (score, -cost) > (self.best["score"], -self.best["cost"]):
+            self.best = plan
+        return True
+
+    def __sample(self):
+        """Draws a random plan of one or two unit types on one spawn location"""
+        rng = self.__random
+        wait = rng.randrange(len(self.__budgets))
+        budget = self.__budgets[wait]
+        location = rng.choice(self.__locations)
+        types = rng.sample(self.unit_types, min(len(self.unit_types), rng.choice((1, 2))))
+        units = []
+        for index, unit_type in enumerate(types):
+            affordable = self.__affordable(unit_type, budget)
+            if affordable <= 0:
+                continue
+            # The last type spends what is left, earlier ones take a random share
+            num = affordable if index == len(types) - 1 else rng.randint(1, affordable)
+            units.append((unit_type, location, num))
+            budget -= num * self.game_state.type_cost(unit_type)[self.game_state.MP]
+        return wait, units
+
+    def __affordable(self, unit_type, budget):
+        """The number of a mobile unit type a given amount of MP pays for"""
+        cost = self.game_state.type_cost(unit_type)[self.game_state.MP]
+        return int(budget // cost) if cost > 0 else 0
+
+    def __path(self, location):
+        """Gets the path from a spawn location and the damage per frame summed along it"""
+        key = (location[0], location[1])
+        entry = self.__paths.get(key)
+        if entry is None:
+            path = self.game_state.find_path_to_edge(location)
+            entry = (path, self.game_state.path_damage(path) if path else 0)
+            self.__paths[key] = entry
+        return entry
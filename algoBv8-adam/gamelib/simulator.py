@@ -0,0 +1,350 @@
+from .unit import get_unit_stats
+
+
+class _Mover:
+    """The simulation state of one mobile unit"""
+    __slots__ = ("unit", "target_edge", "edge_tiles", "path", "path_index", "steps", "progress", "shielded_by")
+
+    def __init__(self, unit, target_edge, edge_tiles):
+        self.unit = unit
+        self.target_edge = target_edge
+        self.edge_tiles = edge_tiles
+        self.path = None
+        self.path_index = 0
+        self.steps = 0
+        self.progress = 0
+        self.shielded_by = set()
+
+
+class ActionPhaseSimulator:
+    """Predicts the action phase that follows the turn being built, one frame at a time
+
+    The simulation runs on a fork of the GameState it is given, so the structures and mobile
+    units already placed with attempt_spawn, attempt_upgrade and attempt_remove are part of it
+    and the original GameState is never changed. Each frame follows the order of the engine:
+
+        1. Supports shield friendly mobile units in range, once per support and unit
+        2. Mobile units that are due to move take one step along their path. Units reaching their
+           target edge breach, and units stuck at the end of their path self destruct
+        3. Every unit that can attack hits the target get_target chooses, all at the same time
+        4. Units left without health are destroyed. If a structure was destroyed, mobile units re-path
+
+    Once no mobile units are left, structures flagged for removal are removed and refunded.
+    Units re-path from where they stand, so a unit whose path changes mid-walk may take a slightly
+    different route than the engine, which also remembers the direction it last moved in.
+
+    Attributes :
+        * game_state (GameState): The board being simulated, a fork of the one passed in
+        * frame (int): The number of frames simulated so far
+        * frames (list): A summary dict for each simulated frame, see step
+        * breaches ([int, int]): The number of units that breached, for each player
+        * player_damage ([float, float]): The health each player took from breaches
+        * damage_dealt ([float, float]): The damage each player's units dealt to enemy units
+        * destroyed (list): (unit_type, [x, y], player_index) of each structure destroyed
+        * refunds ([float, float]): The SP each player got back from removed structures
+
+    """
+    def __init__(self, game_state, enemy_units=None):
+        """Sets up a simulation of the action phase that follows the turn being built
+
+        Args:
+            game_state: The GameState to simulate from. It is not modified.
+            enemy_units: A list of (unit_type, [x, y], num) mobile units the enemy is expected to deploy
+
+        """
+        state = game_state.fork()
+        state.suppress_warnings(True)
+        self.game_state = state
+        self.config = state.config
+        self.frame = 0
+        self.frames = []
+        self.breaches = [0, 0]
+        self.player_damage = [0, 0]
+        self.damage_dealt = [0, 0]
+        self.destroyed = []
+        self.refunds = [0, 0]
+        self.__finished = False
+        self.__dying = []
+        self.__stats = get_unit_stats(self.config)
+        self.__unit_info = {info.get("shorthand"): info for info in self.config["unitInformation"]}
+        self.__sp_per_damage = self.config["resources"].get("coresForPlayerDamage", 1)
+        game_map = state.game_map
+
+        remove = self.config["unitInformation"][6]["shorthand"]
+        for action, x, y in state._build_stack:
+            if action == remove:
+                for unit in game_map._own_tile(x, y):
+                    if unit.stationary:
+                        game_map._set_pending_removal(unit)
+        for unit_type, location, num in enemy_units or []:
+            for _ in range(num):
+                game_map.add_unit(unit_type, location, 1)
+
+        edge_tiles = {}
+        self.__movers = []
+        for player_index in (0, 1):
+            for x, y in game_map.get_unit_locations(player_index):
+                if game_map.is_blocked([x, y]):
+                    continue
+                target_edge = state.get_target_edge([x, y])
+                if target_edge not in edge_tiles:
+                    edge_tiles[target_edge] = {tuple(location) for location in game_map.get_edge_locations(target_edge)}
+                for unit in game_map._own_tile(x, y):
+                    if not unit.stationary and unit.player_index == player_index:
+                        self.__movers.append(_Mover(unit, target_edge, edge_tiles[target_edge]))
+
+    def is_finished(self):
+        """Returns True once no mobile units are left and removals have been applied"""
+        return self.__finished
+
+    def run(self, max_frames=1000):
+        """Simulates frames until no mobile units are left, then applies removals and refunds
+
+        Args:
+            max_frames: The most frames to simulate, in case units never leave the board
+
+        Returns:
+            A dict with the per frame summaries under "frames", the final GameState under "game_state",
+            and the "breaches", "player_damage", "damage_dealt", "destroyed" and "refunds" totals
+
+        """
+        while self.__movers and self.frame < max_frames:
+            self.step()
+        self.finish()
+        return {
+            "frames": self.frames,
+            "game_state": self.game_state,
+            "breaches": self.breaches,
+            "player_damage": self.player_damage,
+            "damage_dealt": self.damage_dealt,
+            "destroyed": self.destroyed,
+            "refunds": self.refunds,
+        }
+
+    def step(self):
+        """Simulates one frame
+
+        Returns:
+            A dict summarizing the frame. "breaches", "damage_dealt", "self_destructs", "destroyed"
+            and "mobile_units" each hold one number per player, and "frame" is the frame number.
+
+        """
+        self.frame += 1
+        summary = {
+            "frame": self.frame,
+            "breaches": [0, 0],
+            "damage_dealt": [0, 0],
+            "self_destructs": [0, 0],
+            "destroyed": [0, 0],
+            "mobile_units": [0, 0],
+        }
+        self.__shield()
+        self.__move(summary)
+        self.__attack(summary)
+        self.__remove_dead(summary)
+        for mover in self.__movers:
+            summary["mobile_units"][mover.unit.player_index] += 1
+        self.frames.append(summary)
+        return summary
+
+    def finish(self):
+        """Removes and refunds the structures flagged for removal, ending the simulation"""
+        if self.__finished:
+            return
+        self.__finished = True
+        state = self.game_state
+        game_map = state.game_map
+        for player_index in (0, 1):
+            for x, y in game_map.get_pending_removal_locations(player_index):
+                kept = []
+                for unit in game_map._own_tile(x, y):
+                    if unit.stationary and unit.pending_removal:
+                        refund_percentage = self.__unit_info[unit.unit_type].get("refundPercentage", 0)
+                        refund = refund_percentage * unit.cost[state.SP] * unit.health / unit.max_health
+                        self.refunds[player_index] += refund
+                        state._player_resources[player_index]["SP"] += refund
+                    else:
+                        kept.append(unit)
+                game_map[x, y] = kept
+
+    def __shield(self):
+        """Shields mobile units that are in range of a friendly support they were not shielded by yet"""
+        game_map = self.game_state.game_map
+        supports = []
+        for (player_index, unit_type), locations in game_map._unit_index.items():
+            if player_index not in (0, 1):
+                continue
+            for upgraded in (False, True):
+                stats = self.__stats.get((unit_type, upgraded))
+                if stats is None or not stats.stationary or stats.shieldRange <= 0:
+                    continue
+                for x, y in locations:
+                    for unit in game_map[x, y]:
+                        if unit.upgraded == upgraded and (unit.shieldPerUnit > 0 or unit.shieldBonusPerY > 0):
+                            supports.append(unit)
+        if not supports:
+            return
+
+        for mover in self.__movers:
+            unit = mover.unit
+            for support in supports:
+                key = (support.x, support.y)
+                if support.player_index != unit.player_index or key in mover.shielded_by:
+                    continue
+                if (support.x - unit.x) ** 2 + (support.y - unit.y) ** 2 >= (support.shieldRange + game_map._hit_radius) ** 2:
+                    continue
+                # The bonus grows with distance from the support owner's own edge
+                rows = support.y if support.player_index == 0 else game_map.ARENA_SIZE - 1 - support.y
+                mover.shielded_by.add(key)
+                game_map.set_unit_health(unit, unit.health + support.shieldPerUnit + support.shieldBonusPerY * rows)
+
+    def __move(self, summary):
+        """Moves the mobile units that are due to move, then handles breaches and self destructs"""
+        state = self.game_state
+        game_map = state.game_map
+        moves = []
+        stuck = []
+        for mover in self.__movers:
+            unit = mover.unit
+            mover.progress += unit.speed
+            if mover.progress < 1:
+                continue
+            mover.progress -= 1
+            if mover.path is None:
+                mover.path = state.find_path_to_edge([unit.x, unit.y], mover.target_edge)
+                mover.path_index = 0
+            if mover.path and mover.path_index + 1 < len(mover.path):
+                mover.path_index += 1
+                mover.steps += 1
+                moves.append((mover, mover.path[mover.path_index]))
+            else:
+                stuck.append(mover)
+
+        if moves:
+            # Take every moving unit off its tile before putting any of them down, so a unit is never indexed twice
+            self.__take_off_board([mover.unit for mover, _ in moves])
+            arriving = {}
+            for mover, (x, y) in moves:
+                mover.unit.x, mover.unit.y = x, y
+                arriving.setdefault((x, y), []).append(mover.unit)
+            for (x, y), units in arriving.items():
+                game_map[x, y] = game_map._own_tile(x, y) + units
+
+        gone = set()
+        for mover, (x, y) in moves:
+            if (x, y) in mover.edge_tiles:
+                player_index = mover.unit.player_index
+                damage = self.__unit_info[mover.unit.unit_type].get("playerBreachDamage", 1)
+                summary["breaches"][player_index] += 1
+                self.breaches[player_index] += 1
+                self.player_damage[1 - player_index] += damage
+                state._player_resources[player_index]["SP"] += damage * self.__sp_per_damage
+                if player_index == 0:
+                    state.enemy_health -= damage
+                else:
+                    state.my_health -= damage
+                gone.add(id(mover.unit))
+        for mover in stuck:
+            summary["self_destructs"][mover.unit.player_index] += 1
+            gone.add(id(mover.unit))
+            self.__self_destruct(mover, summary)
+
+        if gone:
+            self.__take_off_board([mover.unit for mover in self.__movers if id(mover.unit) in gone])
+            self.__movers = [mover for mover in self.__movers if id(mover.unit) not in gone]
+
+    def __self_destruct(self, mover, summary):
+        """Damages the enemy units around a unit that cannot move any further, if it walked far enough"""
+        unit = mover.unit
+        unit_info = self.__unit_info[unit.unit_type]
+        if mover.steps < unit_info.get("selfDestructStepsRequired", 0):
+            return
+        radius = unit_info.get("selfDestructRange", 0)
+        if radius <= 0:
+            return
+        game_map = self.game_state.game_map
+        for location in game_map.get_locations_in_range([unit.x, unit.y], radius):
+            for target in list(game_map[location]):
+                if target.player_index == unit.player_index or target.health <= 0:
+                    continue
+                if target.stationary:
+                    damage = unit_info.get("selfDestructDamageTower", 0)
+                else:
+                    damage = unit_info.get("selfDestructDamageWalker", 0)
+                if damage > 0:
+                    summary["damage_dealt"][unit.player_index] += damage
+                    self.damage_dealt[unit.player_index] += damage
+                    self.__damage(target, damage)
+
+    def __attack(self, summary):
+        """Every unit that can attack hits its target, with all targets chosen before any damage is dealt"""
+        state = self.game_state
+        game_map = state.game_map
+        attackers = []
+        # Only structures that can reach a tile holding an enemy mobile unit have anything to shoot at
+        in_reach = 0
+        for mover in self.__movers:
+            unit = mover.unit
+            attackers.append(unit)
+            in_reach |= game_map._attacker_masks[unit.player_index][unit.x * game_map.ARENA_SIZE + unit.y]
+        for location in game_map.get_locations_from_mask(in_reach | self.__structure_attackers()):
+            attackers.extend(unit for unit in game_map[location] if unit.stationary)
+        if not attackers:
+            return
+
+        damage_by_target = {}
+        for attacker, target in zip(attackers, state.get_targets(attackers)):
+            if target is None:
+                continue
+            damage = attacker.damage_f if target.stationary else attacker.damage_i
+            summary["damage_dealt"][attacker.player_index] += damage
+            self.damage_dealt[attacker.player_index] += damage
+            entry = damage_by_target.get(id(target))
+            if entry is None:
+                damage_by_target[id(target)] = [target, damage]
+            else:
+                entry[1] += damage
+        for target, damage in damage_by_target.values():
+            self.__damage(target, damage)
+
+    def __structure_attackers(self):
+        """Gets a bitmask of the structures that can attack enemy structures"""
+        game_map = self.game_state.game_map
+        mask = 0
+        for unit_type, type_mask in game_map._type_masks.items():
+            if self.__stats[unit_type, False].damage_f > 0 or self.__stats[unit_type, True].damage_f > 0:
+                mask |= type_mask
+        return mask
+
+    def __damage(self, unit, damage):
+        """Lowers the health of a unit still on the board"""
+        unit = self.game_state.game_map.set_unit_health(unit, unit.health - damage)
+        if unit is not None and unit.health <= 0:
+            self.__dying.append(unit)
+
+    def __remove_dead(self, summary):
+        """Takes the units without health off the board, and re-paths mobile units if a structure was destroyed"""
+        if not self.__dying:
+            return
+        dead = list({id(unit): unit for unit in self.__dying}.values())
+        self.__dying = []
+        structure_destroyed = False
+        for unit in dead:
+            if unit.stationary:
+                structure_destroyed = True
+                summary["destroyed"][unit.player_index] += 1
+                self.destroyed.append((unit.unit_type, [unit.x, unit.y], unit.player_index))
+        self.__take_off_board(dead)
+        self.__movers = [mover for mover in self.__movers if mover.unit.health > 0]
+        if structure_destroyed:
+            for mover in self.__movers:
+                mover.path = None
+
+    def __take_off_board(self, units):
+        """Removes units from their tiles, leaving the other units on those tiles in place"""
+        game_map = self.game_state.game_map
+        by_tile = {}
+        for unit in units:
+            by_tile.setdefault((unit.x, unit.y), set()).add(id(unit))
+        for (x, y), ids in by_tile.items():
+            game_map[x, y] = [unit for unit in game_map._own_tile(x, y) if id(unit) not in ids]
@@ -1,7 +1,17 @@
 import unittest
 import json
+import io
+import time
+from contextlib import redirect_stdout
+from . import util
 from .game_state import GameState
 from .unit import GameUnit
+from .transposition import TranspositionTable
+from .simulator import ActionPhaseSimulator
+from .batch_simulator import BatchSimulator
+from .planner import AttackPlanner
+from . import algocore
+from .algocore import AlgoCore
 
 class BasicTests(unittest.TestCase):
 
@@ -240,6 +250,660 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(1, len(game.game_map.get_locations_in_range([13,13], 0)), "We should be in 0 range of ourself")
         self.assertEqual(37, len(game.game_map.get_locations_in_range([13,13], 3.5)), "Wrong number of tiles in range")
 
+    def test_pathing(self):
+        game = self.make_turn_0_map()
+        path = game.find_path_to_edge([13, 0])
+        self.assertEqual([[13, 0], [13, 1], [14, 1], [14, 2]], path[:4], "Units should zig-zag towards their target edge")
+        self.assertEqual([27, 14], path[-1], "Path should end on the top right edge")
+        self.assertEqual(29, len(path), "Wrong path length on an empty board")
+        self.assertEqual([0, 14], game.find_path_to_edge([14, 0])[-1], "Path should end on the top left edge")
+
+        for location in [[12, 1], [13, 2], [14, 1]]:
+            game.game_map.add_unit("FF", location)
+        self.assertEqual([[13, 1]], game.find_path_to_edge([13, 1]), "A boxed in unit should stay in its most ideal tile")
+        self.assertEqual(None, game.find_path_to_edge([13, 2]), "Pathing from a blocked tile should fail")
+
+    def test_path_cache(self):
+        game = self.make_turn_0_map()
+        path = game.find_path_to_edge([13, 0])
+        path.append([0, 0])
+        self.assertEqual(path[:-1], game.find_path_to_edge([13, 0]), "Cached paths should not be shared with callers")
+        game.game_map.add_unit("FF", [13, 1])
+        self.assertEqual([[13, 0], [14, 0], [14, 1]], game.find_path_to_edge([13, 0])[:3], "Adding a structure should invalidate the cached path")
+        game.game_map.remove_unit([13, 1])
+        self.assertEqual(path[:-1], game.find_path_to_edge([13, 0]), "Removing a structure should invalidate the cached path")
+        game.attempt_spawn("FF", [13, 1])
+        self.assertEqual([14, 0], game.find_path_to_edge([13, 0])[1], "Spawning a structure should invalidate the cached path")
+
+    def test_batch_pathing(self):
+        game = self.make_turn_0_map()
+        for location in [[12, 1], [13, 2], [14, 1], [20, 10]]:
+            game.game_map.add_unit("FF", location)
+        starts = [[13, 0], [13, 1], [14, 0], [20, 10], [3, 17]]
+        paths = game.find_paths_to_edges(starts)
+        self.assertEqual(None, paths[3], "Pathing from a blocked tile should fail")
+        for start, path in zip(starts, paths):
+            if path is not None:
+                self.assertEqual(game.find_path_to_edge(start), path, "Batch path from {} does not match the single path".format(start))
+
+    def test_incremental_pathing(self):
+        game = self.make_turn_0_map()
+        walls = [[x, 10] for x in range(4, 24)] + [[13, 5], [14, 6], [12, 12]]
+        starts = [[13, 0], [14, 0], [3, 10], [24, 10], [13, 11]]
+        game.find_paths_to_edges(starts)
+        for wall in walls:
+            game.game_map.add_unit("FF", wall)
+            game.find_paths_to_edges(starts)
+        game.game_map.remove_unit([13, 10])
+        game.game_map.remove_unit([13, 5])
+
+        fresh = self.make_turn_0_map()
+        for wall in walls:
+            if wall not in [[13, 10], [13, 5]]:
+                fresh.game_map.add_unit("FF", wall)
+        for start in starts:
+            self.assertEqual(fresh.find_path_to_edge(start), game.find_path_to_edge(start), "Repaired paths from {} differ from a fresh search".format(start))
+
+    def test_occupancy(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        game_map.add_unit("FF", [13, 1], 0)
+        game_map.add_unit("DF", [14, 1], 0)
+        game_map.add_unit("DF", [14, 20], 1)
+        game_map.add_unit("PI", [13, 0], 0)
+        self.assertEqual(3, game_map.count_structures(), "Mobile units should not count as structures")
+        self.assertEqual(2, game_map.count_structures("DF"), "There should be two turrets")
+        self.assertEqual(1, game_map.count_structures("DF", 1), "There should be one enemy turret")
+        self.assertEqual([[14, 1], [14, 20]], game_map.get_locations_from_mask(game_map.get_occupancy("DF")), "Turret locations are wrong")
+        self.assertTrue(game_map.is_blocked([13, 1]), "A wall should block its tile")
+        self.assertFalse(game_map.is_blocked([13, 0]), "A mobile unit should not block its tile")
+
+        game_map.add_unit("EF", [13, 1], 1)
+        self.assertEqual(0, game_map.count_structures("FF"), "Replaced structures should leave the bitboards")
+        self.assertEqual(2, game_map.count_structures(player_index=1), "The enemy should own the replacement")
+        game_map.remove_unit([14, 1])
+        self.assertFalse(game.contains_stationary_unit([14, 1]), "Removed structures should leave the bitboards")
+        self.assertEqual(2, game_map.count_structures(), "There should be two structures left")
+
+    def test_map_iteration(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        locations = list(game_map)
+        self.assertEqual(420, len(locations), "There should be 420 locations in the arena")
+        self.assertEqual([[13, 0], [14, 0], [12, 1]], locations[:3], "Iteration should start from the bottom row")
+        self.assertEqual(locations, [a for a, b in zip(game_map, game_map)], "Nested iteration over the map should be independent")
+        self.assertEqual(210, len(list(game_map.get_locations(half=1))), "The top half should have 210 locations")
+
+        game_map.add_unit("FF", [13, 1], 0)
+        game_map.add_unit("FF", [14, 20], 1)
+        self.assertEqual([[14, 20]], list(game_map.get_locations(player_index=1)), "Enemy structures are wrong")
+        self.assertEqual([[13, 1], [14, 20]], list(game_map.get_locations(occupied=True)), "Occupied locations are wrong")
+        self.assertEqual(209, len(list(game_map.get_locations(half=0, occupied=False))), "Empty locations are wrong")
+
+    def test_range_tables(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        for center in [[13, 13], [0, 13], [14, 0], [20, 20]]:
+            for radius in [1.5, 2.5, 3.5, 4.5]:
+                expected = [[x, y] for x in range(28) for y in range(28) if game_map.in_arena_bounds([x, y]) and game_map.distance_between_locations(center, [x, y]) < radius + 0.01]
+                self.assertEqual(expected, game_map.get_locations_in_range(center, radius), "Wrong locations in range {} of {}".format(radius, center))
+        in_range = game_map.get_locations_in_range([13, 13], 3.5)
+        in_range.pop()
+        in_range[0][0] = -1
+        self.assertEqual(37, len(game_map.get_locations_in_range([13, 13], 3.5)), "Precomputed results should not be shared with callers")
+        self.assertNotIn(-1, [x for x, _ in game.fork().game_map.get_locations_in_range([13, 13], 3.5)], "Locations should not be shared with callers")
+
+    def test_unit_index(self):
+        game = self.make_turn_0_map()
+        turn = json.loads(game.serialized_string)
+        turn["p2Units"] = [[[3, 14, 75.0, "1"], [4, 14, 75.0, "2"]], [], [[5, 15, 90.0, "3"], [6, 16, 90.0, "4"]], [], [], [], [[3, 14, 0, "5"]], [[5, 15, 0, "6"]]]
+        game = GameState(game.config, json.dumps(turn))
+        game.suppress_warnings(True)
+        game_map = game.game_map
+        self.assertEqual(2, game_map.count_units(1, "FF"), "There should be two enemy walls")
+        self.assertEqual(1, game_map.count_units(1, "DF", rows=[15]), "There should be one enemy turret in row 15")
+        self.assertEqual(0, game_map.count_units(0), "We have no units")
+        self.assertEqual([[5, 15]], game_map.get_upgraded_locations(1), "Parsed upgrades should be indexed")
+        self.assertEqual([[3, 14]], game_map.get_pending_removal_locations(1), "Parsed removals should be indexed")
+
+        game_map.add_unit("PI", [13, 0], 0)
+        game_map.add_unit("PI", [13, 0], 0)
+        self.assertEqual(2, game_map.count_units(0, "PI"), "Stacked mobile units should be counted")
+        game_map.add_unit("SI", [14, 27], 1)
+        self.assertEqual(5, game_map.count_units(1, rows=[14, 15, 16, 27]))
+        self.assertEqual(4, game_map.count_units(1, rows=[14, 15, 16, 27], structures_only=True), "Mobile units are not structures")
+        self.assertEqual([[13, 0]], game_map.get_unit_locations(0), "Stacked mobile units share a location")
+        game_map.add_unit("SI", [13, 0], 0)
+        self.assertEqual([[13, 0]], game_map.get_unit_locations(0), "Unit types sharing a location should list it once")
+        game_map[6, 16][0].upgrade()
+        self.assertEqual([[5, 15], [6, 16]], game_map.get_upgraded_locations(1), "Upgrades should be indexed")
+        game_map.remove_unit([5, 15])
+        self.assertEqual([[6, 16]], [[unit.x, unit.y] for unit in game_map.get_units(1, "DF")], "Removed units should leave the index")
+        self.assertEqual([[6, 16]], game_map.get_upgraded_locations(1), "Removed units should leave the upgrade index")
+
+    def test_fork(self):
+        game = self.make_turn_0_map()
+        game.attempt_spawn("DF", [13, 6])
+        game.game_map.add_unit("FF", [14, 20], 1)
+        path = game.find_path_to_edge([13, 0])
+
+        fork = game.fork()
+        fork.attempt_spawn("FF", [13, 1])
+        fork.attempt_upgrade([13, 6])
+        fork.game_map.remove_unit([14, 20])
+        self.assertEqual(23, game.get_resource(game.SP), "Spending in a fork should not affect the original")
+        self.assertEqual([("DF", 13, 6)], game._build_stack, "Spawning in a fork should not affect the original")
+        self.assertFalse(game.game_map[13, 6][0].upgraded, "Upgrading in a fork should not affect the original")
+        self.assertTrue(fork.game_map[13, 6][0].upgraded, "The fork should see its own upgrade")
+        self.assertEqual(1, game.game_map.count_units(1), "Removing in a fork should not affect the original")
+        self.assertEqual(path, game.find_path_to_edge([13, 0]), "Forks should not change the original's paths")
+        self.assertNotEqual(path, fork.find_path_to_edge([13, 0]), "Forks should path around their own structures")
+
+        game.game_map.remove_unit([13, 6])
+        self.assertTrue(fork.contains_stationary_unit([13, 6]), "Changing the original should not affect the fork")
+
+    def test_fork_unit_upgrade(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        game_map.add_unit("DF", [13, 16], 1)
+        original = game_map[13, 16][0]
+        threat = game_map.get_threat_map(0)
+
+        forked = game_map.fork()
+        forked[13, 16][0].upgrade()
+        self.assertTrue(forked[13, 16][0].upgraded, "The fork should see upgrades made through its units")
+        self.assertEqual([[13, 16]], forked.get_upgraded_locations(1))
+        self.assertNotEqual(threat, forked.get_threat_map(0), "Upgrading through a fork should update its threat map")
+        self.assertFalse(original.upgraded, "Upgrading through a fork should not change the original's units")
+        self.assertFalse(game_map[13, 16][0].upgraded)
+        self.assertEqual([], game_map.get_upgraded_locations(1), "Upgrading through a fork should not change the original's index")
+        self.assertEqual(threat, game_map.get_threat_map(0), "Upgrading through a fork should not change the original's threat map")
+
+        game_map.add_unit("DF", [13, 5], 0)
+        turret = game_map[13, 5][0]
+        forked = game_map.fork()
+        turret.upgrade()
+        self.assertTrue(turret.upgraded, "Units read before a fork should stay live in the original")
+        self.assertIs(turret, game_map[13, 5][0])
+        self.assertEqual([[13, 5]], game_map.get_upgraded_locations(0))
+        self.assertFalse(forked[13, 5][0].upgraded, "Upgrading the original should not change the fork")
+        self.assertEqual([], forked.get_upgraded_locations(0))
+        game_map.remove_unit([13, 5])
+        self.assertEqual(1, len(forked[13, 5]), "Removing from the original should not change the fork")
+        stale = GameUnit("DF", game.config, 0, None, 13, 16)
+        stale._game_map = game_map
+        with self.assertRaises(ValueError, msg="Upgrading a unit that is not on its map should not silently do nothing"):
+            stale.upgrade()
+
+    def test_hypothetical(self):
+        game = self.make_turn_0_map()
+        game.attempt_spawn("DF", [13, 6])
+        game.game_map.add_unit("FF", [14, 20], 1)
+        path = game.find_path_to_edge([13, 0])
+        turret = game.game_map[13, 6][0]
+
+        with game.hypothetical():
+            game.attempt_spawn("FF", [13, 1])
+            game.attempt_upgrade([13, 6])
+            game.attempt_remove([13, 6])
+            game.game_map.remove_unit([14, 20])
+            game.attempt_spawn("PI", [13, 0], 2)
+            game.begin()
+            game.game_map.add_unit("FF", [13, 7])
+            game.commit()
+            self.assertNotEqual(path, game.find_path_to_edge([13, 0]), "Hypothetical structures should change the path")
+
+        self.assertEqual(23, game.get_resource(game.SP), "Rollback should restore SP")
+        self.assertEqual(5, game.get_resource(game.MP), "Rollback should restore MP")
+        self.assertEqual([("DF", 13, 6)], game._build_stack, "Rollback should restore the build stack")
+        self.assertEqual([], game._deploy_stack, "Rollback should restore the deploy stack")
+        self.assertFalse(game.game_map[13, 6][0].upgraded, "Rollback should undo upgrades")
+        self.assertIs(turret, game.game_map[13, 6][0], "Rollback should put back the units that were on the map")
+        self.assertFalse(turret.upgraded, "Rollback should undo upgrades of units held before the transaction")
+        self.assertFalse(turret.pending_removal)
+        self.assertEqual([], game.game_map.get_upgraded_locations(0), "Rollback should restore the upgrade index")
+        self.assertEqual([], game.game_map[13, 0], "Rollback should remove mobile units")
+        self.assertFalse(game.contains_stationary_unit([13, 7]), "Rollback should undo committed nested changes")
+        self.assertEqual(1, game.game_map.count_units(1), "Rollback should restore removed units")
+        self.assertEqual(path, game.find_path_to_edge([13, 0]), "Rollback should restore the path")
+
+    def test_zobrist_hash(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        empty = game_map.zobrist_hash()
+        game_map.add_unit("FF", [13, 6])
+        game_map.add_unit("DF", [14, 20], 1)
+        game_map.add_unit("PI", [13, 0])
+        game_map.add_unit("PI", [13, 0])
+        board = game_map.zobrist_hash()
+        self.assertNotEqual(empty, board, "Adding units should change the hash")
+
+        other = self.make_turn_0_map().game_map
+        other.add_unit("PI", [13, 0])
+        other.add_unit("DF", [14, 20], 1)
+        other.add_unit("PI", [13, 0])
+        other.add_unit("FF", [13, 6])
+        self.assertEqual(board, other.zobrist_hash(), "Equal boards should have equal hashes")
+        other.remove_unit([13, 0])
+        other.add_unit("PI", [13, 0])
+        self.assertNotEqual(board, other.zobrist_hash(), "Stacked mobile units should be counted")
+
+        forked = game_map.fork()
+        forked.remove_unit([13, 6])
+        forked.add_unit("FF", [13, 6])
+        self.assertEqual(board, forked.zobrist_hash(), "Removing and re-adding a unit should restore the hash")
+        game.attempt_upgrade([13, 6])
+        upgraded = game_map.zobrist_hash()
+        self.assertNotEqual(board, upgraded, "Upgrading should change the hash")
+        self.assertEqual(board, forked.zobrist_hash(), "Upgrading should not change the hash of a fork")
+
+        wall = game_map.set_unit_health(game_map[13, 6][0], 10)
+        self.assertEqual(10, game_map[13, 6][0].health, "set_unit_health should set health")
+        self.assertIs(wall, game_map[13, 6][0], "set_unit_health should return the changed unit")
+        self.assertNotEqual(upgraded, game_map.zobrist_hash(), "Changing health should change the hash")
+        with game.hypothetical():
+            game_map.remove_unit([14, 20])
+        self.assertEqual(game_map.zobrist_hash(), game_map.fork().zobrist_hash(), "Rollback should restore the hash")
+
+    def test_transposition_table(self):
+        game = self.make_turn_0_map()
+        table = TranspositionTable(max_size=2)
+        calls = []
+        def evaluate(state):
+            calls.append(state.board_hash())
+            return len(calls)
+
+        self.assertEqual(1, game.memoize(table, evaluate, "a"))
+        self.assertEqual(1, game.memoize(table, evaluate, "a"), "Repeated evaluations should be cached")
+        self.assertEqual(2, game.memoize(table, evaluate, "b"), "Different keys should be evaluated separately")
+        self.assertEqual(1, game.memoize(table, evaluate, "a"))
+        game.game_map.add_unit("FF", [13, 6])
+        self.assertEqual(3, game.memoize(table, evaluate, "a"), "Different boards should be evaluated separately")
+        self.assertEqual(2, len(table), "The table should stay within its size")
+        game.game_map.remove_unit([13, 6])
+        self.assertEqual(1, game.memoize(table, evaluate, "a"), "Recently used entries should be kept")
+        self.assertEqual(4, game.memoize(table, evaluate, "b"), "The least recently used entry should be evicted")
+        self.assertEqual(3, table.hits)
+
+    def test_build_plan(self):
+        game = self.make_turn_0_map()
+        game.suppress_warnings(True)
+        resources = game.get_resources()
+        plan = [("FF", [13, 6]), ("UP", [13, 6]), ("FF", [13, 6]), ("RM", [13, 6]), ("PI", [13, 0], 3),
+                ("PI", [13, 1]), ("DF", [14, 20]), ("UP", [1, 12]), ("XX", [13, 6])]
+        expected = game.fork()
+        expected.attempt_spawn("FF", [13, 6])
+        expected.attempt_upgrade([13, 6])
+        expected.attempt_remove([13, 6])
+        expected.attempt_spawn("PI", [13, 0], 3)
+
+        report = game.apply_build_plan(plan, dry_run=True)
+        self.assertEqual([1, 1, 0, 1, 3, 0, 0, 0, 0], [result["succeeded"] for result in report["results"]])
+        self.assertEqual([2, 3], report["cost"], "The report should total the cost of the plan")
+        self.assertEqual("Location is blocked.", report["results"][2]["reason"])
+        self.assertEqual([], game._build_stack, "A dry run should not change the game state")
+        self.assertEqual(resources, game.get_resources(), "A dry run should not change resources")
+        self.assertEqual([], game.game_map[13, 6], "A dry run should not change the map")
+
+        self.assertEqual(report, game.apply_build_plan(plan))
+        self.assertEqual(expected._build_stack, game._build_stack, "Plans should match the attempt functions")
+        self.assertEqual(expected._deploy_stack, game._deploy_stack, "Plans should match the attempt functions")
+        self.assertEqual(expected.get_resources(), game.get_resources(), "Plans should match the attempt functions")
+        self.assertEqual(expected.board_hash(), game.board_hash(), "Plans should match the attempt functions")
+
+    def test_lazy_parsing(self):
+        config = self.make_turn_0_map().config
+        p1_units = [[[13, 6, 60.0, "1"]], [], [[12, 6, 75.0, "2"]], [[13, 0, 15.0, "3"], [13, 0, 15.0, "4"]], [], [], [[13, 6, 0, "5"]], [[12, 6, 0, "6"]]]
+        p2_units = [[], [[14, 20, 30.0, "7"]], [], [], [], [[14, 27, 40.0, "8"]], [], []]
+        turn = json.dumps({"p1Units": p1_units, "p2Units": p2_units, "turnInfo": [0, 3, -1],
+                           "p1Stats": [30.0, 25.0, 5.0, 0], "p2Stats": [30.0, 25.0, 5.0, 0]})
+        eager = GameState(config, turn)
+        lazy = GameState(config, turn, lazy=True)
+
+        self.assertEqual(eager.board_hash(), lazy.board_hash(), "Lazy parsing should hash the same board")
+        self.assertEqual(eager.game_map.structure_occupancy(), lazy.game_map.structure_occupancy())
+        self.assertEqual(eager.game_map.get_upgraded_locations(0), lazy.game_map.get_upgraded_locations(0))
+        self.assertEqual(eager.game_map.get_pending_removal_locations(0), lazy.game_map.get_pending_removal_locations(0))
+        self.assertEqual(2, lazy.game_map.count_units(0, "PI"), "Lazy parsing should index units")
+        forked = lazy.fork()
+        forked.game_map.remove_unit([13, 0])
+        for location in lazy.game_map:
+            self.assertEqual(str(eager.game_map[location]), str(lazy.game_map[location]), "Lazy parsing should create the same units")
+        self.assertEqual(75.0, lazy.game_map[12, 6][0].health)
+        self.assertTrue(lazy.game_map[12, 6][0].upgraded)
+        self.assertEqual(eager.game_map[12, 6][0].attackRange, lazy.game_map[12, 6][0].attackRange)
+
+    def test_unit_stats(self):
+        config = self.make_turn_0_map().config
+        turret = GameUnit("DF", config, 0, None, 3, 12)
+        other = GameUnit("DF", config, 1, 40.0, 4, 15)
+        self.assertIs(turret._stats, other._stats, "Units of one type should share their stats")
+        self.assertEqual(turret.max_health, turret.health, "Health should default to the starting health")
+        self.assertEqual(40.0, other.health)
+        with self.assertRaises(AttributeError):
+            turret.note = "Units should not have a __dict__"
+
+        unit_info = config["unitInformation"][2]
+        cost = turret.cost
+        health = turret.health
+        turret.upgrade()
+        self.assertTrue(turret.upgraded)
+        self.assertFalse(other.upgraded, "Upgrading should not change other units")
+        self.assertEqual(unit_info["upgrade"].get("attackRange", unit_info["attackRange"]), turret.attackRange)
+        self.assertEqual(unit_info["upgrade"].get("attackDamageWalker", unit_info["attackDamageWalker"]), turret.damage_i)
+        self.assertEqual([cost[0] + unit_info["upgrade"].get("cost1", 0), cost[1] + unit_info["upgrade"].get("cost2", 0)], turret.cost)
+        self.assertEqual(health, turret.health, "Upgrading should not change health")
+
+    def test_unit_arrays(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        arrays = game.get_unit_arrays()
+        game_map.add_unit("DF", [3, 15], 1)
+        game_map.add_unit("DF", [3, 16], 1)
+        game_map.add_unit("DF", [5, 15], 1)
+        game_map.add_unit("FF", [4, 16], 1)
+        game_map.add_unit("PI", [13, 0])
+        game.attempt_spawn("DF", [13, 6])
+        self.assertEqual(6, len(arrays))
+
+        turret_health = game_map[3, 15][0].max_health
+        totals = arrays.column_totals(arrays.health, 1, "DF")
+        self.assertEqual(2 * turret_health, totals[3], "Column totals should sum each column")
+        self.assertEqual(turret_health, totals[5])
+        self.assertEqual(3 * turret_health, arrays.total(arrays.health, 1, "DF"))
+        self.assertEqual(game.type_cost("DF")[game.SP], arrays.structure_value(0), "Mobile units should not count as structures")
+
+        with game.hypothetical():
+            game.attempt_upgrade([13, 6])
+            game_map.remove_unit([3, 16])
+            game_map.set_unit_health(game_map[3, 15][0], 1)
+            self.assertEqual(game.type_cost("DF", True)[game.SP] + game.type_cost("DF")[game.SP], arrays.structure_value(0))
+            self.assertEqual([1], [arrays.health[entry] for entry in arrays.entries(1, "DF") if arrays.x[entry] == 3])
+            self.assertEqual(1, sum(arrays.upgraded[entry] for entry in arrays.entries(0)))
+        self.assertEqual(totals, arrays.column_totals(arrays.health, 1, "DF"), "Rollback should restore the arrays")
+
+        forked = game.fork()
+        forked.game_map.remove_unit([3, 15])
+        self.assertEqual(6, len(arrays), "Forks should have their own arrays")
+        self.assertEqual(5, len(forked.get_unit_arrays()))
+
+    def test_threat_maps(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        game_map.add_unit("DF", [13, 16], 1)
+        game_map.add_unit("DF", [16, 14], 1)
+        game_map.add_unit("FF", [12, 16], 1)
+        game_map.add_unit("DF", [13, 10], 0)
+        for location in game_map:
+            damage = sum(unit.damage_i for unit in game.get_attackers(location, 0))
+            self.assertEqual(damage, game_map.get_threat(location, 0), "Threat maps should match get_attackers")
+        self.assertEqual(0, game_map.get_threat([13, 13], 1), "Structures should not threaten their own units")
+        self.assertEqual(game_map[13, 10][0].damage_i, game_map.get_threat([13, 12], 1))
+
+        turret = game_map[13, 16][0]
+        out_of_base_range = [13, 13]
+        self.assertEqual(0, game_map.get_threat(out_of_base_range, 0))
+        turret.upgrade()
+        self.assertEqual(turret.damage_i, game_map.get_threat(out_of_base_range, 0), "Upgrades should extend range and damage")
+        path = [[13, 12], [13, 13], [13, 14]]
+        self.assertEqual(sum(game_map.get_threat(location, 0) for location in path), game.path_damage(path))
+
+        durability = game_map.get_durability_map(0)
+        for location in game_map:
+            health = sum(unit.health for unit in game.get_attackers(location, 0))
+            self.assertEqual(health, durability[location[0] * 28 + location[1]], "Durability should sum the health of the attackers")
+        game_map.set_unit_health(turret, 10)
+        self.assertEqual(10 + game_map[16, 14][0].health, game_map.get_durability_map(0)[14 * 28 + 14], "Durability should follow health changes")
+        game_map.remove_unit([13, 16])
+        game_map.remove_unit([16, 14])
+        self.assertEqual(0, game.path_damage(path), "Removing structures should remove their threat")
+        self.assertEqual(0, sum(game_map.get_durability_map(0)))
+
+    def test_attacker_index(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        game_map.add_unit("DF", [14, 14], 1)
+        game_map.add_unit("DF", [12, 14], 1)
+        game_map.add_unit("FF", [13, 14], 1)
+        game_map.add_unit("DF", [12, 12], 0)
+        self.assertEqual([[12, 14], [14, 14]], game_map.get_attacker_locations([13, 13], 0), "Only enemy turrets should attack")
+        self.assertEqual([[12, 12]], game_map.get_attacker_locations([13, 13], 1))
+
+        self.assertEqual([], game_map.get_attacker_locations([13, 11], 0))
+        game_map[12, 14][0].upgrade()
+        self.assertEqual([[12, 14]], game_map.get_attacker_locations([13, 11], 0), "Upgrades should extend the index")
+        game_map.remove_unit([14, 14])
+        self.assertEqual([[12, 14]], game_map.get_attacker_locations([13, 13], 0), "Removed turrets should leave the index")
+
+        game_map.add_unit("SI", [11, 15], 1)
+        attackers = game.get_attackers([13, 13], 0)
+        self.assertEqual([[11, 15], [12, 14]], [[unit.x, unit.y] for unit in attackers], "Mobile attackers should be included in order")
+
+    def test_get_targets(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        game_map.add_unit("DF", [13, 13], 0)
+        game_map.add_unit("DF", [13, 16], 1)
+        game_map.add_unit("FF", [12, 14], 1)
+        game_map.add_unit("FF", [15, 14], 1)
+        game_map.add_unit("PI", [14, 14], 1)
+        game_map.add_unit("PI", [12, 15], 1)
+        game_map.add_unit("SI", [13, 12], 0)
+        attackers = [game_map[13, 13][0], game_map[13, 16][0], game_map[14, 14][0], game_map[13, 12][0], game_map[12, 14][0]]
+        targets = game.get_targets(attackers)
+        self.assertEqual([game.get_target(unit) for unit in attackers], targets, "get_targets should match get_target")
+        self.assertIs(game_map[14, 14][0], targets[0], "Turrets should prefer the nearest mobile unit")
+
+        game_map.remove_unit([14, 14])
+        game_map.remove_unit([12, 15])
+        targets = game.get_targets(attackers[:2])
+        self.assertEqual([game.get_target(unit) for unit in attackers[:2]], targets, "get_targets should match get_target")
+        self.assertIsNone(targets[0], "Turrets should not target structures")
+
+    def test_simulator(self):
+        game = self.make_turn_0_map()
+        game.attempt_spawn("PI", [13, 0], 3)
+        game.attempt_spawn("FF", [5, 10])
+        game.attempt_remove([5, 10])
+        board_hash = game.board_hash()
+        result = ActionPhaseSimulator(game).run()
+        final = result["game_state"]
+        self.assertEqual(board_hash, game.board_hash(), "Simulating should not change the game state")
+        self.assertEqual([3, 0], result["breaches"], "Every scout should reach the enemy edge on an empty board")
+        self.assertEqual(27, final.enemy_health)
+        self.assertEqual(0.75 * final.type_cost("FF")[final.SP], result["refunds"][0])
+        self.assertEqual(game.get_resource(game.SP) + 3 + result["refunds"][0], final.get_resource(final.SP))
+        self.assertFalse(final.contains_stationary_unit([5, 10]), "Removed structures should be gone after the action phase")
+        self.assertEqual(0, final.game_map.count_units(0), "No mobile units should be left")
+
+        game = self.make_turn_0_map()
+        game.game_map.add_unit("DF", [13, 3], 1)
+        game.attempt_spawn("PI", [13, 0])
+        result = ActionPhaseSimulator(game).run()
+        self.assertEqual([0, 0], result["breaches"], "The turret should destroy the scout")
+        self.assertEqual([0, 0], result["frames"][-1]["mobile_units"])
+        self.assertEqual(15, result["damage_dealt"][1], "The turret should deal the scout's full health")
+
+        game = self.make_turn_0_map()
+        game.game_map.add_unit("EI", [18, 4], 0)
+        game.game_map.add_unit("SI", [18, 4], 0)
+        game.game_map.add_unit("SI", [18, 4], 0)
+        result = ActionPhaseSimulator(game).run()
+        self.assertEqual([3, 0], result["breaches"], "Unit types sharing a spawn tile should each be simulated once")
+
+    def test_batch_simulator(self):
+        game = self.make_turn_0_map()
+        game_map = game.game_map
+        for location in ([12, 15], [15, 15], [9, 18], [18, 18], [13, 17]):
+            game_map.add_unit("DF", location, 1)
+        game_map.add_unit("FF", [14, 16], 1)
+        results = BatchSimulator(game).simulate_spawns(["PI", "EI", "SI"], num=3)
+        self.assertEqual(3 * 28, len(results), "Every edge location should be simulated for every unit type")
+        for (unit_type, location), result in results.items():
+            single = game.fork()
+            for _ in range(3):
+                single.game_map.add_unit(unit_type, list(location), 0)
+            expected = ActionPhaseSimulator(single).run()
+            self.assertEqual(expected["breaches"][0], result["breaches"], "{} at {}".format(unit_type, location))
+            self.assertEqual(expected["damage_dealt"][0], result["damage_dealt"], "{} at {}".format(unit_type, location))
+            self.assertEqual(len(expected["destroyed"]), result["structures_destroyed"], "{} at {}".format(unit_type, location))
+        self.assertEqual(0, game_map.count_units(0), "The batch should not change the game state")
+
+        # Several stacks per scenario, unit types sharing a tile and a friendly support shielding them
+        config = json.loads(json.dumps(game.config))
+        config["unitInformation"][1].update(shieldRange=3.5, shieldPerUnit=18.0, shieldBonusPerY=0.5)
+        game = GameState(config, game.serialized_string)
+        game.suppress_warnings(True)
+        for x in range(28):
+            if x != 13:
+                game.game_map.add_unit("DF", [x, 14], 1)
+        game.game_map[12, 14][0].upgrade()
+        game.game_map.add_unit("EF", [13, 3], 0)
+        scenarios = [[("EI", [13, 0], 2), ("SI", [13, 0], 1)],
+                     [("PI", [13, 0], 3), ("PI", [14, 0], 2), ("EI", [5, 8], 1)],
+                     [("PI", [12, 1], 4), ("SI", [12, 1], 2), ("EI", [15, 1], 1)],
+                     [("SI", [20, 6], 1), ("PI", [7, 6], 5), ("PI", [14, 0], 1)]]
+        results = BatchSimulator(game).run(scenarios)
+        self.assertEqual([0, 1, 0, 0], [result["breaches"] for result in results], "Only shielded scouts should get through")
+        for scenario, result in zip(scenarios, results):
+            single = game.fork()
+            for unit_type, location, num in scenario:
+                for _ in range(num):
+                    single.game_map.add_unit(unit_type, location, 0)
+            expected = ActionPhaseSimulator(single).run()
+            self.assertEqual(expected["breaches"][0], result["breaches"], scenario)
+            self.assertEqual(expected["damage_dealt"][0], result["damage_dealt"], scenario)
+            self.assertEqual(len(expected["destroyed"]), result["structures_destroyed"], scenario)
+
+    def test_attack_planner(self):
+        game = self.make_turn_0_map()
+        self.assertIsNone(AttackPlanner(game, seed=0).search(deadline=0), "Nothing should be scored after the deadline")
+
+        for x in range(4, 24):
+            game.game_map.add_unit("DF", [x, 15], 1)
+        planner = AttackPlanner(game, seed=0)
+        best = planner.search(max_samples=300)
+        self.assertEqual(300, planner.samples)
+        self.assertGreater(best["breaches"], 0, "Some units should get past the turrets")
+        self.assertEqual(0, best["wait"], "Saving MP should not pay off on this board")
+        for unit_type, location, num in best["units"]:
+            self.assertLessEqual(num, game.number_affordable(unit_type))
+        self.assertEqual(best, AttackPlanner(game, seed=0).search(max_samples=300), "Searches with the same seed should agree")
+        self.assertEqual(sum(num for _, _, num in best["units"]), planner.execute())
+        self.assertEqual(0, game.get_resource(game.MP) // 1, "The best plan should spend our MP")
+
+    def test_turn_clock(self):
+        algo = AlgoCore()
+        algo._set_turn_budget({"timingAndReplay": {"waitTimeBotSoft": 2000}})
+        self.assertEqual(2, algo.time_remaining(), "The whole budget should be left outside of a turn")
+        algo._begin_turn(0, 0)
+        self.assertTrue(algo.checkpoint("start"))
+        self.assertFalse(algo.checkpoint("late", reserve=2), "No time should be left beyond the budget")
+        self.assertLessEqual(algo.time_remaining(), 2)
+        self.assertAlmostEqual(algo.turn_deadline(0.5), algo._turn_start + 1)
+        self.assertEqual(["start", "late"], [name for name, _ in algo.checkpoints])
+        algo._end_turn()
+        algo._begin_turn(1, 1234)
+        algo._end_turn()
+        self.assertEqual([0, 1], [entry["turn"] for entry in algo.turn_times])
+        self.assertEqual([1234, None], [entry["my_time"] for entry in algo.turn_times], "Engine times arrive a turn late")
+        self.assertGreaterEqual(algo.turn_times[0]["compute_time"], 0)
+
+    def test_fallback_turn(self):
+        self.addCleanup(setattr, util, "_submission_open", None)
+        game = self.make_turn_0_map()
+        fallback = game.fork()
+        fallback.attempt_spawn("FF", [13, 13])
+        algo = AlgoCore()
+        algo.turn_time_limit = 0.05
+        output = io.StringIO()
+        with redirect_stdout(output):
+            algo._begin_turn(0, 0)
+            algo.register_fallback(fallback)
+            time.sleep(0.2)
+            game.attempt_spawn("DF", [13, 13])
+            self.assertFalse(game.submit_turn(), "A turn submitted after the fallback should be discarded")
+            algo._end_turn()
+        self.assertEqual(['[["FF", 13, 13]]', "[]"], output.getvalue().splitlines(), "Only the fallback should be sent")
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            algo.turn_time_limit = 30
+            algo._begin_turn(1, 0)
+            algo.register_fallback(fallback)
+            self.assertTrue(game.submit_turn())
+            algo._end_turn()
+        self.assertEqual(['[["DF", 13, 13]]', "[]"], output.getvalue().splitlines(), "A turn on time should not be replaced")
+
+    def test_background_tasks(self):
+        algo = AlgoCore()
+        algo.register_background_task("frames", lambda frame, seen: (seen or []) + [frame], every_frame=True)
+        algo.register_background_task("latest", lambda frame, latest: frame)
+        for frame in range(5):
+            algo._queue_background_frame(frame)
+        algo._collect_background_results()
+        self.assertEqual([0, 1, 2, 3, 4], algo.background_results["frames"], "Every frame should be seen in order")
+        self.assertEqual(4, algo.background_results["latest"], "The result should come from the latest frame")
+
+        algo._queue_background_frame(5)
+        algo._collect_background_results()
+        self.assertEqual([5], algo.background_results["frames"], "Results should start over every action phase")
+
+        class Algo(AlgoCore):
+            def on_turn(self, turn_state):
+                self.elapsed = self.turn_elapsed()
+                self.results = dict(self.background_results)
+
+        turn = '{"turnInfo":[0,1,-1],"p1Stats":[30.0,25.0,5.0,0]}'
+        original_get_command = algocore.get_command
+        self.addCleanup(setattr, algocore, "get_command", original_get_command)
+        for budget in (5, 0.1):
+            messages = iter([turn, turn.replace('"turnInfo":[0,', '"turnInfo":[2,')])
+            algocore.get_command = lambda: next(messages)
+            algo = Algo()
+            algo.register_background_task("slow", lambda frame, result: time.sleep(0.2) or frame)
+            algo._queue_background_frame(0)
+            algo.turn_budget = budget
+            with redirect_stdout(io.StringIO()):
+                algo.start()
+            if budget == 5:
+                self.assertEqual({"slow": 0}, algo.results)
+                self.assertGreaterEqual(algo.elapsed, 0.15, "Waiting for background tasks should count against the turn clock")
+            else:
+                self.assertEqual({}, algo.results, "A low budget should cut the wait short")
+                self.assertLess(algo.elapsed, 0.1, "The wait should leave on_turn half of the budget")
+
+    def test_message_dispatch(self):
+        turn = '{"p2Units":[[],[],[],[],[],[],[]],"turnInfo":[0,3,-1],"p1Stats":[30.0,25.0,5.0,412],"p1Units":[[],[],[],[],[],[],[]],"p2Stats":[30.0,25.0,5.0,0],"events":{}}'
+        frame = turn.replace('"turnInfo":[0,3,-1]', '"turnInfo":[1,3,7]')
+        end = turn.replace('"turnInfo":[0,3,-1]', '"turnInfo":[2,3,-1]')
+        self.assertEqual([0, 3, -1], algocore._scan_list(turn, "turnInfo"))
+        self.assertEqual(412, algocore._scan_list(turn, "p1Stats")[3])
+        self.assertIsNone(algocore._scan_list('{"replaySave":1}', "turnInfo"))
+
+        class Algo(AlgoCore):
+            parsed_messages = True
+
+            def on_turn(self, turn_state):
+                self.turns.append(turn_state)
+
+        messages = iter([turn, frame, frame, end])
+        original_get_command = algocore.get_command
+        algocore.get_command = lambda: next(messages)
+        self.addCleanup(setattr, algocore, "get_command", original_get_command)
+        algo = Algo()
+        algo.turns = []
+        algo.on_action_frame = None  # Frames must not be dispatched without a subscriber
+        with redirect_stdout(io.StringIO()):
+            algo.start()
+        self.assertEqual([json.loads(turn)], algo.turns, "on_turn should get the decoded turn state")
+        self.assertEqual(3, algo.turn_times[0]["turn"])
+
+        game = self.make_turn_0_map()
+        from_dict = GameState(game.config, json.loads(turn))
+        self.assertEqual(GameState(game.config, turn).board_hash(), from_dict.board_hash())
+        self.assertEqual(3, from_dict.turn_number)
+
     def _test_get_attackers(self):
         game = self.make_turn_0_map()
         
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+
+class TranspositionTable:
+    """A bounded cache of evaluations keyed by board hash, for reusing work across plans and turns
+
+    Keys are usually built from GameMap.zobrist_hash, together with anything else the
+    evaluation depends on, such as resources or the plan being tested. When the table is
+    full, the least recently used entry is evicted.
+
+    Attributes :
+        * max_size (int): The most entries the table will hold
+        * hits (int): The number of lookups that found an entry
+        * misses (int): The number of lookups that did not find an entry
+
+    """
+    def __init__(self, max_size=65536):
+        """Creates an empty table
+
+        Args:
+            max_size: The most entries the table will hold
+
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def get(self, key, default=None):
+        """Gets the value stored for a key, marking it as recently used
+
+        Args:
+            key: The key to look up
+            default: The value to return if the key is not in the table
+
+        Returns:
+            The stored value, or default
+        """
+        value = self.__entries.get(key, self)
+        if value is self:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.__entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Stores a value for a key, evicting the least recently used entry if the table is full
+
+        Args:
+            key: The key to store the value under
+            value: The value to store
+        """
+        self.__entries[key] = value
+        self.__entries.move_to_end(key)
+        if len(self.__entries) > self.max_size:
+            self.__entries.popitem(last=False)
+
+    def clear(self):
+        """Removes every entry from the table"""
+        self.__entries.clear()
+        self.hits = 0
+        self.misses = 0
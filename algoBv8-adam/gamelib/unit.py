@@ -1,3 +1,7 @@
+from collections import namedtuple
+from operator import attrgetter
+
+
 def is_stationary(unit_type, structure_types):
     """
         Args:
@@ -9,9 +13,76 @@ def is_stationary(unit_type, structure_types):
     return unit_type in structure_types
 
 
+UnitStats = namedtuple("UnitStats", ["stationary", "speed", "damage_f", "damage_i", "attackRange", "shieldRange",
+                                     "max_health", "shieldPerUnit", "shieldBonusPerY", "cost", "upgraded"])
+
+# Compiled stats for each config, keyed by id(config). The config is kept with its stats so the id stays valid.
+_STATS_BY_CONFIG = {}
+
+
+def _compile_unit_stats(config):
+    """Builds the shared base and upgraded UnitStats of every unit type in a config"""
+    stats = {}
+    for type_config in config["unitInformation"]:
+        if "shorthand" not in type_config:
+            continue
+        base = UnitStats(
+            stationary=type_config.get("unitCategory") == 0,
+            speed=type_config.get("speed", 0),
+            damage_f=type_config.get("attackDamageTower", 0),
+            damage_i=type_config.get("attackDamageWalker", 0),
+            attackRange=type_config.get("attackRange", 0),
+            shieldRange=type_config.get("shieldRange", 0),
+            max_health=type_config.get("startHealth", 0),
+            shieldPerUnit=type_config.get("shieldPerUnit", 0),
+            shieldBonusPerY=type_config.get("shieldBonusPerY", 0),
+            cost=(type_config.get("cost1", 0), type_config.get("cost2", 0)),
+            upgraded=False)
+        upgrade_config = type_config.get("upgrade", {})
+        upgraded = UnitStats(
+            stationary=base.stationary,
+            speed=upgrade_config.get("speed", base.speed),
+            damage_f=upgrade_config.get("attackDamageTower", base.damage_f),
+            damage_i=upgrade_config.get("attackDamageWalker", base.damage_i),
+            attackRange=upgrade_config.get("attackRange", base.attackRange),
+            shieldRange=upgrade_config.get("shieldRange", base.shieldRange),
+            max_health=upgrade_config.get("startHealth", base.max_health),
+            shieldPerUnit=upgrade_config.get("shieldPerUnit", base.shieldPerUnit),
+            shieldBonusPerY=upgrade_config.get("shieldBonusPerY", base.shieldBonusPerY),
+            cost=(upgrade_config.get("cost1", 0) + base.cost[0], upgrade_config.get("cost2", 0) + base.cost[1]),
+            upgraded=True)
+        stats[type_config["shorthand"], False] = base
+        stats[type_config["shorthand"], True] = upgraded
+    return stats
+
+
+def get_unit_stats(config):
+    """Gets the shared UnitStats for a config, compiling them the first time the config is seen
+
+    Args:
+        config: The game config
+
+    Returns:
+        A dict from (unit_type, upgraded) to UnitStats
+    """
+    entry = _STATS_BY_CONFIG.get(id(config))
+    if entry is None or entry[0] is not config:
+        entry = (config, _compile_unit_stats(config))
+        _STATS_BY_CONFIG[id(config)] = entry
+    return entry[1]
+
+
+def _stat_property(name):
+    """A read only attribute that comes from the unit's shared stats"""
+    return property(attrgetter("_stats." + name))
+
+
 class GameUnit:
     """Holds information about a Unit. 
 
+    Stats that only depend on the unit type and whether it is upgraded are stored once per config
+    in a shared UnitStats record. Only the location, health, owner and flags are stored on each unit.
+
     Attributes :
         * unit_type (string): This unit's type
         * config (JSON): Contains information about the game
@@ -32,6 +103,20 @@ class GameUnit:
         * upgraded (boolean): If this unit is upgraded
 
     """
+    __slots__ = ["unit_type", "config", "player_index", "pending_removal", "x", "y", "health",
+                 "_stats", "_game_map", "_zobrist_key", "_slot"]
+
+    stationary = _stat_property("stationary")
+    speed = _stat_property("speed")
+    damage_f = _stat_property("damage_f")
+    damage_i = _stat_property("damage_i")
+    attackRange = _stat_property("attackRange")
+    shieldRange = _stat_property("shieldRange")
+    max_health = _stat_property("max_health")
+    shieldPerUnit = _stat_property("shieldPerUnit")
+    shieldBonusPerY = _stat_property("shieldBonusPerY")
+    upgraded = _stat_property("upgraded")
+
     def __init__(self, unit_type, config, player_index=None, health=None, x=-1, y=-1):
         """ Initialize unit variables using args passed
 
@@ -40,41 +125,38 @@ class GameUnit:
         self.config = config
         self.player_index = player_index
         self.pending_removal = False
-        self.upgraded = False
         self.x = x
         self.y = y
-        self.__serialize_type()
-        self.health = self.max_health if not health else health
-
-    def __serialize_type(self):
-        from .game_state import STRUCTURE_TYPES, UNIT_TYPE_TO_INDEX, SUPPORT
-        type_config = self.config["unitInformation"][UNIT_TYPE_TO_INDEX[self.unit_type]]
-        self.stationary = type_config["unitCategory"] == 0
-        self.speed = type_config.get("speed", 0)
-        self.damage_f = type_config.get("attackDamageTower", 0)
-        self.damage_i = type_config.get("attackDamageWalker", 0)
-        self.attackRange = type_config.get("attackRange", 0)
-        self.shieldRange = type_config.get("shieldRange", 0)
-        self.max_health = type_config.get("startHealth", 0)
-        self.shieldPerUnit = type_config.get("shieldPerUnit", 0)
-        self.shieldBonusPerY = type_config.get("shieldBonusPerY", 0)
-        self.cost = [type_config.get("cost1", 0), type_config.get("cost2", 0)]
+        self._game_map = None
+        self._zobrist_key = 0
+        self._slot = -1
+        self._stats = get_unit_stats(config)[unit_type, False]
+        self.health = self._stats.max_health if not health else health
 
+    def __copy__(self):
+        unit = GameUnit.__new__(GameUnit)
+        unit.unit_type = self.unit_type
+        unit.config = self.config
+        unit.player_index = self.player_index
+        unit.pending_removal = self.pending_removal
+        unit.x = self.x
+        unit.y = self.y
+        unit.health = self.health
+        unit._stats = self._stats
+        unit._game_map = self._game_map
+        unit._zobrist_key = self._zobrist_key
+        unit._slot = self._slot
+        return unit
 
-    def upgrade(self):
-        from .game_state import UNIT_TYPE_TO_INDEX
-        type_config = self.config["unitInformation"][UNIT_TYPE_TO_INDEX[self.unit_type]].get("upgrade", {})
-        self.speed = type_config.get("speed", self.speed)
-        self.damage_f = type_config.get("attackDamageTower", self.damage_f)
-        self.damage_i = type_config.get("attackDamageWalker", self.damage_i)
-        self.attackRange = type_config.get("attackRange", self.attackRange)
-        self.shieldRange = type_config.get("shieldRange", self.shieldRange)
-        self.max_health = type_config.get("startHealth", self.max_health)
-        self.shieldPerUnit = type_config.get("shieldPerUnit", self.shieldPerUnit)
-        self.shieldBonusPerY = type_config.get("shieldBonusPerY", self.shieldBonusPerY)
-        self.cost = [type_config.get("cost1", 0) + self.cost[0], type_config.get("cost2", 0) + self.cost[1]]
-        self.upgraded = True
+    @property
+    def cost(self):
+        return list(self._stats.cost)
 
+    def upgrade(self):
+        if self._game_map is not None:
+            self._game_map._upgrade_unit(self)
+            return
+        self._stats = get_unit_stats(self.config)[self.unit_type, True]
 
     def __toString(self):
         owner = "Friendly" if self.player_index == 0 else "Enemy"
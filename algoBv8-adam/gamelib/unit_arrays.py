@@ -0,0 +1,157 @@
+from array import array
+
+from .unit import get_unit_stats
+from .navigation import ARENA_SIZE
+
+
+class UnitArrays:
+    """Holds every unit on a GameMap as parallel arrays, one entry per unit
+
+    GameMap keeps this up to date as units are added, removed, upgraded, flagged for removal
+    or have their health set, so aggregates over the whole board can be computed with a single
+    pass over flat arrays instead of visiting every tile. Entries of removed units are reused,
+    so always check alive.
+
+    Attributes :
+        * x (array): The x coordinate of each unit
+        * y (array): The y coordinate of each unit
+        * unit_type (array): The index of each unit's type in the config's unitInformation
+        * player_index (array): The player that controls each unit, or -1 if it has no owner
+        * health (array): The current health of each unit
+        * upgraded (array): 1 if the unit is upgraded, 0 otherwise
+        * pending_removal (array): 1 if the unit is marked for removal by its owner, 0 otherwise
+        * alive (array): 1 if the entry holds a unit, 0 if it is free
+        * type_index (dict): Maps each unit type shorthand to its index
+
+    """
+    def __init__(self, config):
+        """Creates an empty set of arrays
+
+        Args:
+            config (JSON): Contains information about the game
+
+        """
+        self.config = config
+        self.type_index = {}
+        for index, unit_info in enumerate(config["unitInformation"]):
+            if "shorthand" in unit_info:
+                self.type_index[unit_info["shorthand"]] = index
+        self.x = array("b")
+        self.y = array("b")
+        self.unit_type = array("b")
+        self.player_index = array("b")
+        self.health = array("d")
+        self.upgraded = array("b")
+        self.pending_removal = array("b")
+        self.alive = array("b")
+        self._free = []
+
+    def __len__(self):
+        return len(self.alive) - len(self._free)
+
+    def copy(self):
+        """Gets an independent copy of these arrays"""
+        copied = UnitArrays.__new__(UnitArrays)
+        copied.config = self.config
+        copied.type_index = self.type_index
+        for name in ("x", "y", "unit_type", "player_index", "health", "upgraded", "pending_removal", "alive"):
+            setattr(copied, name, array(getattr(self, name).typecode, getattr(self, name)))
+        copied._free = list(self._free)
+        return copied
+
+    def _add(self, unit_type, player_index, upgraded, pending_removal, health, x, y):
+        """Stores a unit and returns its entry"""
+        owner = -1 if player_index is None else player_index
+        if self._free:
+            slot = self._free.pop()
+            self.x[slot] = x
+            self.y[slot] = y
+            self.unit_type[slot] = self.type_index[unit_type]
+            self.player_index[slot] = owner
+            self.health[slot] = health
+            self.upgraded[slot] = upgraded
+            self.pending_removal[slot] = pending_removal
+            self.alive[slot] = 1
+            return slot
+        self.x.append(x)
+        self.y.append(y)
+        self.unit_type.append(self.type_index[unit_type])
+        self.player_index.append(owner)
+        self.health.append(health)
+        self.upgraded.append(upgraded)
+        self.pending_removal.append(pending_removal)
+        self.alive.append(1)
+        return len(self.alive) - 1
+
+    def _remove(self, slot):
+        """Frees the entry of a removed unit"""
+        self.alive[slot] = 0
+        self._free.append(slot)
+
+    def entries(self, player_index=None, unit_type=None):
+        """Gets the entries of the units matching a player and type
+
+        Args:
+            player_index: Only include this player's units. All players if None.
+            unit_type: Only include units of this type. All unit types if None.
+
+        Returns:
+            A list of entry indices, usable with any of the arrays
+        """
+        owner = -1 if player_index is None else player_index
+        type_code = -1 if unit_type is None else self.type_index.get(unit_type, -2)
+        return [slot for slot, (alive, unit_owner, unit_code) in enumerate(zip(self.alive, self.player_index, self.unit_type))
+                if alive and (owner == -1 or unit_owner == owner) and (type_code == -1 or unit_code == type_code)]
+
+    def total(self, values, player_index=None, unit_type=None):
+        """Sums one of the arrays over the units matching a player and type
+
+        Args:
+            values: The array to sum, for example health
+            player_index: Only include this player's units. All players if None.
+            unit_type: Only include units of this type. All unit types if None.
+
+        Returns:
+            The sum of values over the matching units
+        """
+        return sum(values[slot] for slot in self.entries(player_index, unit_type))
+
+    def column_totals(self, values, player_index=None, unit_type=None):
+        """Sums one of the arrays over the units matching a player and type, separately for each x
+
+        For example, column_totals(arrays.health, 1, TURRET) gets the total enemy turret health by column.
+
+        Args:
+            values: The array to sum, for example health
+            player_index: Only include this player's units. All players if None.
+            unit_type: Only include units of this type. All unit types if None.
+
+        Returns:
+            A list with the sum for each x coordinate, from 0 to 27
+        """
+        totals = [0] * ARENA_SIZE
+        for slot in self.entries(player_index, unit_type):
+            totals[self.x[slot]] += values[slot]
+        return totals
+
+    def structure_value(self, player_index):
+        """Gets the total SP cost of a player's structures, including upgrades
+
+        Args:
+            player_index: The player whose structures are valued
+
+        Returns:
+            The SP spent on the structures currently on the board
+        """
+        stats = get_unit_stats(self.config)
+        costs = {}
+        for unit_type, index in self.type_index.items():
+            for upgraded in (False, True):
+                unit_stats = stats.get((unit_type, upgraded))
+                if unit_stats is not None and unit_stats.stationary:
+                    costs[index, upgraded] = unit_stats.cost[0]
+        value = 0
+        for alive, owner, type_code, upgraded in zip(self.alive, self.player_index, self.unit_type, self.upgraded):
+            if alive and owner == player_index:
+                value += costs.get((type_code, upgraded == 1), 0)
+        return value
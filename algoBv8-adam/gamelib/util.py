@@ -1,8 +1,14 @@
 import sys
+import threading
 
 
 BANNER_TEXT = "---------------- Starting Your Algo --------------------"
 
+# Makes sure each turn is submitted once, even if AlgoCore's fallback watchdog races the strategy.
+# None outside of turns played through AlgoCore, where every submission goes through.
+_submission_lock = threading.Lock()
+_submission_open = None
+
 
 def get_command():
     """Gets input from stdin
@@ -29,6 +35,37 @@ def send_command(cmd):
     sys.stdout.write(cmd.strip() + "\n")
     sys.stdout.flush()
 
+def open_submission():
+    """Lets the next call to submit_commands through and discards any after it.
+    Called by AlgoCore when a turn starts.
+
+    """
+    global _submission_open
+    with _submission_lock:
+        _submission_open = True
+
+def submit_commands(build_string, deploy_string):
+    """Sends the build and deploy commands of a turn, unless the turn was already submitted
+
+    Args:
+        build_string: The build phase command
+        deploy_string: The deploy phase command
+
+    Returns:
+        True if the commands were sent, False if they were discarded because the turn was already submitted
+
+    """
+    global _submission_open
+    with _submission_lock:
+        if _submission_open is False:
+            debug_write("The turn was already submitted, discarding a late submission")
+            return False
+        if _submission_open:
+            _submission_open = False
+        send_command(build_string)
+        send_command(deploy_string)
+        return True
+
 def debug_write(*msg):
     """Prints a message to the games debug output
 